@@ -1,9 +1,13 @@
-from IPython import get_ipython
+import sys
 
+if 'IPython' in sys.modules:
+    # running inside IPython session, smart autoreload modules on changes
+    from IPython import get_ipython
 
-ip = get_ipython()
-ip.run_line_magic('load_ext', 'autoreload')
-ip.run_line_magic('autoreload', '2')  # smart autoreload modules on changes
+    ip = get_ipython()
+    if ip:
+        ip.run_line_magic('load_ext', 'autoreload')
+        ip.run_line_magic('autoreload', '2')
 
 import sfs_cabinet
 import os
@@ -9,6 +9,8 @@ module won't be applicable to other fonts in general.
 //John Yeung  2009-09-02
 '''
 
+from functools import lru_cache
+
 charwidths = {
     '0': 262.637,
     '1': 262.637,
@@ -170,3 +172,53 @@ def fitheight(data, bold=False):
     if bold:
         units *= 1.1
     return int(units)
+
+
+class _WidthTable(dict):
+    default = 0
+
+    def __missing__(self, char):
+        return self.default
+
+
+class TextMetrics(object):
+    '''
+    fitwidth with char widths precomputed into lookup table
+    and bounded LRU cache keyed by (text, bold)
+    '''
+
+    def __init__(self, widths=charwidths, default=charwidths['0'], maxsize=8192):
+        # Latin and Cyrillic prefilled, so lookup of common text does not fall to __missing__
+        self.table = _WidthTable((chr(i), widths.get(chr(i), default)) for i in range(0x530))
+        self.table.update(widths)
+        self.table.default = default
+        self.fitwidth = lru_cache(maxsize=maxsize)(self._fitwidth)
+
+    def _fitwidth(self, data, bold=False):
+        getwidth = self.table.__getitem__
+        maxunits = max(220 + sum(map(getwidth, ndata)) for ndata in data.split("\n"))
+        if bold:
+            maxunits *= 1.1
+        return max(maxunits, 700)  # Don't go smaller than a reported width of 2
+
+    def cache_info(self):
+        return self.fitwidth.cache_info()
+
+
+metrics = TextMetrics()
+
+
+class ColumnAutofit(object):
+    '''Deferred autofit: keeps running maximum width per column, set once before save'''
+
+    def __init__(self, metrics=metrics):
+        self.metrics = metrics
+        self.maxwidths = {}
+
+    def add(self, col, data, bold=False):
+        width = self.metrics.fitwidth(data, bold)
+        if width > self.maxwidths.get(col, 0):
+            self.maxwidths[col] = width
+
+    def widths(self):
+        return dict(self.maxwidths)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''
+Scraping throughput against local mock_cabinet.py: inns per minute of get_info,
+get_report_status and send_outbox. sfs_cabinet runs from temporary copy with stub keys,
+so real keys, reports and sfs.db are not touched. Needs chrome and chromedriver.
+
+    python benchmark_cabinet.py [--inns=5] [--latency=0.1] [--tasks=get_info,send_outbox]
+
+Options of sfs_cabinet (--workers=, --rate=, ...) are applied to it's config.
+Step timings summary is logged at the end, with --keep temporary directory is not removed.
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import importlib.util
+from time import perf_counter
+
+import mock_cabinet
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TASKS = ('get_info', 'get_report_status', 'send_outbox')
+FIRST_INN = 3000000001
+
+OUTBOX_REPORT = '''<?xml version="1.0" encoding="utf-8"?>
+<DECLAR>
+<DECLARHEAD>
+<TIN>{inn}</TIN>
+<C_DOC>F01</C_DOC>
+<C_DOC_SUB>033</C_DOC_SUB>
+<C_DOC_VER>6</C_DOC_VER>
+<C_DOC_TYPE>0</C_DOC_TYPE>
+<C_DOC_CNT>1</C_DOC_CNT>
+<C_REG>26</C_REG>
+<C_RAJ>58</C_RAJ>
+<PERIOD_MONTH>12</PERIOD_MONTH>
+<PERIOD_TYPE>5</PERIOD_TYPE>
+<PERIOD_YEAR>2018</PERIOD_YEAR>
+<C_STI_ORIG>2658</C_STI_ORIG>
+<C_DOC_STAN>1</C_DOC_STAN>
+</DECLARHEAD>
+<DECLARBODY></DECLARBODY>
+</DECLAR>
+'''
+
+
+def get_option(name, default):
+    prefix = '--{}='.format(name)
+    for arg in sys.argv:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+
+def load_sfs_cabinet(workdir, base_url):
+    '''sfs_cabinet imported from copy in workdir, so all it's files are relative to workdir'''
+    shutil.copy(os.path.join(REPO_DIR, 'sfs_cabinet.py'), workdir)
+    with open(os.path.join(workdir, 'key_password'), 'w') as f:
+        f.write('benchmark')
+    os.environ['SFS_CABINET_URL'] = base_url
+    spec = importlib.util.spec_from_file_location(
+        'sfs_cabinet', os.path.join(workdir, 'sfs_cabinet.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def add_stub_keys(sfs, inns):
+    keys_map = sfs.KeysMap()
+    for inn in inns:
+        fio = 'ТЕСТОВИЙ ПЛАТНИК {}'.format(inn)
+        path = os.path.join(sfs.KEYS_DIR, str(inn), 'key-6.dat')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'inn': inn, 'fio': fio}, f, ensure_ascii=False)
+        keys_map.add_key(inn, fio, path, '01.01.2099')
+
+
+def add_outbox_reports(sfs, inns):
+    for inn in inns:
+        filename = '2658{}F0103306100000000011220182658.xml'.format(inn)
+        with open(os.path.join(sfs.OUTBOX_DIR, filename), 'w', encoding='utf-8') as f:
+            f.write(OUTBOX_REPORT.format(inn=inn))
+
+
+def run_task(sfs, task, inns):
+    if task == 'send_outbox':
+        add_outbox_reports(sfs, inns)
+    started = perf_counter()
+    getattr(sfs, task)()
+    elapsed = perf_counter() - started
+    sfs.metrics.flush()  # per inn results of the task are in metrics.inns
+    failed = [inn for inn in inns if sfs.metrics.inns.get(inn, (None, 'not processed'))[1]]
+    return elapsed, len(failed)
+
+
+def main():
+    inns_count = int(get_option('inns', 5))
+    latency = float(get_option('latency', 0.1))
+    tasks = get_option('tasks', ','.join(TASKS)).split(',')
+    inns = list(range(FIRST_INN, FIRST_INN + inns_count))
+
+    server = mock_cabinet.serve(latency=latency)
+    workdir = tempfile.mkdtemp(prefix='sfs-benchmark-')
+    try:
+        sfs = load_sfs_cabinet(workdir, server.url)
+        sfs.configure(sys.argv[1:])  # --workers, --rate and other options of sfs_cabinet
+        sfs.setup_logging()
+        for dir_ in (sfs.REPORTS_DIR, sfs.OUTBOX_DIR, sfs.SENT_DIR):
+            os.makedirs(dir_, exist_ok=True)
+        add_stub_keys(sfs, inns)
+
+        results = []
+        for task in tasks:
+            elapsed, failed = run_task(sfs, task, inns)
+            results.append((task, elapsed, failed))
+        sfs.metrics.close()
+
+        print('\nmock latency {}s, {} inns'.format(latency, inns_count))
+        print('{:<20} {:>10} {:>10} {:>8}'.format('task', 'seconds', 'inns/min', 'failed'))
+        for task, elapsed, failed in results:
+            print('{:<20} {:>10.1f} {:>10.2f} {:>8}'.format(
+                task, elapsed, inns_count / elapsed * 60, failed))
+        if '--keep' in sys.argv:
+            print('step timings: {}'.format(sfs.metrics.filename))
+    finally:
+        server.shutdown()
+        if '--keep' not in sys.argv:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+'''
+Offline reading of owner fields from X.509 certificates of ukrainian qualified keys:
+certificate chains stored in .jks containers and .cer/.crt files (DER or PEM).
+Only what is needed to match key to taxpayer is parsed, no signature validation.
+'''
+
+import os
+import re
+import fnmatch
+import struct
+import base64
+from datetime import datetime
+
+
+OID_COMMON_NAME = '2.5.4.3'
+OID_SERIAL_NUMBER = '2.5.4.5'
+OID_ORGANIZATION = '2.5.4.10'
+OID_SUBJECT_DIRECTORY_ATTRIBUTES = '2.5.29.9'
+OID_BASIC_CONSTRAINTS = '2.5.29.19'
+OID_DRFO = '1.2.804.2.1.1.1.11.1.4.1.1'  # individual tax number (ДРФО)
+OID_EDRPOU = '1.2.804.2.1.1.1.11.1.4.2.1'  # legal entity code (ЄДРПОУ)
+
+CERT_EXTENSIONS = ('.cer', '.crt')
+JKS_MAGIC = 0xFEEDFEED
+JCEKS_MAGIC = 0xCECECECE
+
+PEM_RE = re.compile(b'-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----', re.DOTALL)
+
+
+class CertError(ValueError):
+    pass
+
+
+def read_tlv(data, offset=0):
+    '''Returns (tag, value_start, value_end) of DER element at offset'''
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+    except IndexError:
+        raise CertError('Truncated DER')
+    if offset + length > len(data):
+        raise CertError('Truncated DER')
+    return tag, offset, offset + length
+
+
+def iter_children(data, start, end):
+    while start < end:
+        tag, value_start, value_end = read_tlv(data, start)
+        yield tag, value_start, value_end
+        start = value_end
+
+
+def decode_oid(value):
+    if not value:
+        raise CertError('Empty OID')
+    first = value[0]
+    parts = [min(first // 40, 2), first - min(first // 40, 2) * 40]
+    n = 0
+    for byte in value[1:]:
+        n = (n << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            parts.append(n)
+            n = 0
+    return '.'.join(map(str, parts))
+
+
+def decode_string(tag, value):
+    if tag == 0x1e:  # BMPString
+        return value.decode('utf-16-be')
+    if tag == 0x1c:  # UniversalString
+        return value.decode('utf-32-be')
+    if tag in (0x0c, 0x13, 0x16, 0x12):  # UTF8, Printable, IA5, Numeric
+        return value.decode('utf-8')
+    return value.decode('latin-1')
+
+
+def decode_time(tag, value):
+    value = value.decode('ascii').rstrip('Z')
+    if tag == 0x17:  # UTCTime
+        return datetime.strptime(value[:12], '%y%m%d%H%M%S')
+    return datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+
+
+def _parse_name(data, start, end):
+    rv = {}
+    for _, set_start, set_end in iter_children(data, start, end):
+        for _, attr_start, attr_end in iter_children(data, set_start, set_end):
+            (_, oid_start, oid_end), (tag, value_start, value_end) = \
+                iter_children(data, attr_start, attr_end)
+            rv[decode_oid(data[oid_start:oid_end])] = \
+                decode_string(tag, data[value_start:value_end])
+    return rv
+
+
+def _parse_directory_attributes(data, start, end):
+    rv = {}
+    _, start, end = read_tlv(data, start)  # SEQUENCE OF Attribute
+    for _, attr_start, attr_end in iter_children(data, start, end):
+        (_, oid_start, oid_end), (_, set_start, set_end) = \
+            iter_children(data, attr_start, attr_end)
+        for tag, value_start, value_end in iter_children(data, set_start, set_end):
+            rv[decode_oid(data[oid_start:oid_end])] = \
+                decode_string(tag, data[value_start:value_end])
+            break
+    return rv
+
+
+def parse_certificate(der):
+    '''Returns dict with subject, issuer, not_before, not_after, is_ca and directory attributes'''
+    _, start, end = read_tlv(der)  # Certificate
+    _, start, end = read_tlv(der, start)  # TBSCertificate
+    fields = list(iter_children(der, start, end))
+    if fields and fields[0][0] == 0xa0:  # explicit version
+        fields = fields[1:]
+    if len(fields) < 6:
+        raise CertError('Unexpected TBSCertificate')
+    _, issuer, validity, subject = fields[1], fields[2], fields[3], fields[4]
+    (nb_tag, nb_start, nb_end), (na_tag, na_start, na_end) = \
+        iter_children(der, validity[1], validity[2])
+
+    rv = {
+        'issuer': _parse_name(der, issuer[1], issuer[2]),
+        'subject': _parse_name(der, subject[1], subject[2]),
+        'not_before': decode_time(nb_tag, der[nb_start:nb_end]),
+        'not_after': decode_time(na_tag, der[na_start:na_end]),
+        'attributes': {},
+        'is_ca': False,
+    }
+    for tag, ext_start, ext_end in fields[6:]:
+        if tag != 0xa3:
+            continue
+        _, seq_start, seq_end = read_tlv(der, ext_start)
+        for _, e_start, e_end in iter_children(der, seq_start, seq_end):
+            children = list(iter_children(der, e_start, e_end))
+            if len(children) < 2:
+                raise CertError('Unexpected extension')
+            oid = decode_oid(der[children[0][1]:children[0][2]])
+            _, value_start, value_end = children[-1]  # OCTET STRING, after optional critical
+            if oid == OID_SUBJECT_DIRECTORY_ATTRIBUTES:
+                rv['attributes'] = _parse_directory_attributes(der, value_start, value_end)
+            elif oid == OID_BASIC_CONSTRAINTS:
+                _, bc_start, bc_end = read_tlv(der, value_start)
+                for bc_tag, v_start, v_end in iter_children(der, bc_start, bc_end):
+                    if bc_tag == 0x01:
+                        rv['is_ca'] = der[v_start:v_end] != b'\x00'
+    return rv
+
+
+def read_jks_certificates(data):
+    '''DER certificates from JKS/JCEKS keystore, certificate entries are not encrypted'''
+    def read(fmt):
+        nonlocal offset
+        values = struct.unpack_from(fmt, data, offset)
+        offset += struct.calcsize(fmt)
+        return values
+
+    def read_bytes():
+        nonlocal offset
+        size, = read('>I')
+        offset += size
+        return data[offset - size:offset]
+
+    def skip_utf():
+        nonlocal offset
+        size, = read('>H')
+        offset += size
+
+    offset = 0
+    try:
+        magic, version, count = read('>III')
+        if magic not in (JKS_MAGIC, JCEKS_MAGIC):
+            raise CertError('Not a JKS keystore')
+        rv = []
+        for _ in range(count):
+            tag, = read('>I')
+            skip_utf()  # alias
+            read('>Q')  # timestamp
+            if tag == 1:  # private key with certificate chain
+                read_bytes()
+                chain_length, = read('>I')
+                for _ in range(chain_length):
+                    if version == 2:
+                        skip_utf()  # certificate type
+                    rv.append(read_bytes())
+            elif tag == 2:  # trusted certificate
+                if version == 2:
+                    skip_utf()
+                rv.append(read_bytes())
+            else:
+                break  # secret key entries are java serialized objects, nothing after is read
+    except struct.error:
+        raise CertError('Truncated JKS keystore')
+    return rv
+
+
+def read_cert_file_certificates(data):
+    pems = PEM_RE.findall(data)
+    if pems:
+        return [base64.b64decode(b''.join(pem.split())) for pem in pems]
+    return [data]
+
+
+def owner_certificates(ders):
+    rv = []
+    for der in ders:
+        try:
+            cert = parse_certificate(der)
+        except (CertError, ValueError, UnicodeDecodeError):
+            continue
+        if not cert['is_ca'] and cert['subject'] != cert['issuer']:
+            rv.append(cert)
+    return rv
+
+
+def key_certificates(key_path, key_patterns):
+    '''
+    Owner certificates from key container itself or .cer/.crt files next to it.
+    Certificates of files can't be matched to encrypted container, so they are used only
+    when key is the only container (of key_patterns, lowercase) in it's directory.
+    '''
+    ders = []
+    if key_path.lower().endswith('.jks'):
+        with open(key_path, 'rb') as f:
+            ders.extend(read_jks_certificates(f.read()))
+    if not ders:
+        dirname = os.path.dirname(key_path)
+        names = sorted(os.listdir(dirname))
+        containers = [name for name in names
+                      if any(fnmatch.fnmatchcase(name.lower(), p) for p in key_patterns)]
+        if len(containers) > 1:
+            return []
+        for name in names:
+            if name.lower().endswith(CERT_EXTENSIONS):
+                with open(os.path.join(dirname, name), 'rb') as f:
+                    ders.extend(read_cert_file_certificates(f.read()))
+    return owner_certificates(ders)
+
+
+def cert_owner_fields(cert):
+    '''(fio, inn, organization, organization_code) as shown in cabinet certInfo'''
+    subject, attributes = cert['subject'], cert['attributes']
+    inn = attributes.get(OID_DRFO)
+    if not inn:
+        # newer certificates may have only subject serialNumber like "TINUA-1234567890"
+        match = re.match(r'^(?:TINUA-|РНОКПП )?(\d{10})$', subject.get(OID_SERIAL_NUMBER, ''))
+        inn = match and match.group(1)
+    return (subject.get(OID_COMMON_NAME, ''), inn or '',
+            subject.get(OID_ORGANIZATION), attributes.get(OID_EDRPOU))
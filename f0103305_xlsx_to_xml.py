@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
-import xml.etree.cElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:  # removed in python 3.9
+    import xml.etree.ElementTree as ET
 import os.path
 from collections import OrderedDict
 import traceback
@@ -0,0 +1,153 @@
+// Minimal behaviour of cabinet SPA pages: data is loaded by XHR after page load,
+// markup keeps classes and texts that sfs_cabinet.py relies on.
+
+function api(method, path, body) {
+    return new Promise(function (resolve, reject) {
+        var xhr = new XMLHttpRequest();
+        xhr.open(method, path);
+        xhr.onload = function () {
+            if (xhr.status === 401) {
+                location.href = '/login';
+                return;
+            }
+            var data = xhr.responseText ? JSON.parse(xhr.responseText) : null;
+            if (xhr.status >= 400) {
+                reject(new Error(data && data.error || xhr.statusText));
+                return;
+            }
+            resolve(data);
+        };
+        xhr.onerror = function () {
+            reject(new Error('Network error'));
+        };
+        if (body instanceof ArrayBuffer || body === undefined) {
+            xhr.send(body || null);
+        } else {
+            xhr.setRequestHeader('Content-Type', 'application/json');
+            xhr.send(JSON.stringify(body));
+        }
+    });
+}
+
+function el(tag, attrs, children) {
+    var element = document.createElement(tag);
+    Object.keys(attrs || {}).forEach(function (name) {
+        if (name === 'text') {
+            element.textContent = attrs[name];
+        } else if (name.indexOf('on') === 0) {
+            element.addEventListener(name.slice(2), attrs[name]);
+        } else {
+            element.setAttribute(name, attrs[name]);
+        }
+    });
+    (children || []).forEach(function (child) {
+        element.appendChild(typeof child === 'string' ? document.createTextNode(child) : child);
+    });
+    return element;
+}
+
+function icon(name, extra) {
+    return el('i', {'class': 'fa fa-' + name + (extra ? ' ' + extra : '')});
+}
+
+function show(element, visible) {
+    element.style.display = visible ? '' : 'none';
+}
+
+function block(visible) {
+    show(document.querySelector('.ui-blockui-document'), visible);
+}
+
+function formatValue(value) {
+    if (value === null || value === undefined) {
+        return '';
+    }
+    if (typeof value !== 'number') {
+        return String(value);
+    }
+    // amounts are grouped by spaces with decimal comma, like '-1 234,56'
+    var parts = value.toFixed(2).split('.');
+    return parts[0].replace(/\B(?=(\d{3})+(?!\d))/g, ' ') + ',' + parts[1];
+}
+
+function readFile(file) {
+    return new Promise(function (resolve, reject) {
+        var reader = new FileReader();
+        reader.onload = function () { resolve(reader.result); };
+        reader.onerror = function () { reject(reader.error); };
+        reader.readAsArrayBuffer(file);
+    });
+}
+
+function showError(container, message) {
+    var alert = container.querySelector('.alert-danger');
+    alert.textContent = message;
+    show(alert, true);
+}
+
+// Key reading form, onRead(owner) is called after certificate info is shown
+function keyForm(container, onRead) {
+    var select = el('select', {id: 'selectedCAs111'}, [el('option', {text: 'Визначити автоматично'})]);
+    var fileInput = el('input', {id: 'PKeyFileInput', type: 'file'});
+    var password = el('input', {type: 'password'});
+    var alert = el('div', {'class': 'alert alert-danger', style: 'display: none'});
+    var certInfo = el('div', {id: 'certInfo', style: 'display: none'});
+
+    function read() {
+        show(alert, false);
+        show(certInfo, false);
+        if (!fileInput.files.length) {
+            return showError(container, 'Не обрано файл ключа');
+        }
+        if (!password.value) {
+            return showError(container, 'Невірний пароль');
+        }
+        readFile(fileInput.files[0]).then(function (data) {
+            return api('POST', '/mock/cert', data);
+        }).then(function (owner) {
+            certInfo.innerHTML = '';
+            certInfo.appendChild(el('div', {text: 'Власник: ' + owner.fio + ' (' + owner.inn + ')'}));
+            if (owner.org) {
+                certInfo.appendChild(el('div', {
+                    text: 'Організація : ' + owner.org + ' (' + owner.org_code + ')'}));
+            }
+            certInfo.appendChild(el('div', {text: 'ЦСК: ' + select.value}));
+            certInfo.appendChild(el('div', {text: 'Термін дії: ' + owner.issued + '-' + owner.expires}));
+            show(certInfo, true);
+            onRead(owner);
+        }).catch(function (e) {
+            showError(container, e.message);
+        });
+    }
+
+    api('GET', '/mock/ca').then(function (names) {
+        names.forEach(function (name) {
+            select.appendChild(el('option', {text: name}));
+        });
+    });
+    [select, fileInput, password, el('button', {type: 'button', text: 'Зчитати', onclick: read}),
+     alert, certInfo].forEach(function (element) {
+        container.appendChild(el('div', {'class': 'form-group'}, [element]));
+    });
+}
+
+function dropdown(container, items, onSelect) {
+    var label = container.querySelector('.ui-dropdown-label');
+    function open() {
+        var menu = el('ul', {'class': 'ui-dropdown-items'});
+        items.forEach(function (item) {
+            menu.appendChild(el('li', {}, [el('span', {text: item, onclick: function (event) {
+                event.stopPropagation();
+                menu.parentNode.removeChild(menu);
+                label.textContent = item;
+                onSelect(item);
+            }})]));
+        });
+        container.appendChild(menu);
+    }
+    label.addEventListener('click', open);
+    var trigger = container.querySelector('.ui-dropdown-trigger');
+    if (trigger) {
+        trigger.addEventListener('click', open);
+    }
+}
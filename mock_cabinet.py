@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+'''
+Local stand-in for cabinet.sfs.gov.ua serving synthetic fixtures,
+to run cabinet code without live portal and real keys.
+
+Pages (fixtures/pages) load their data by XHR like cabinet SPA does, every response
+can be delayed by latency seconds to resemble the portal. Key files are not decrypted:
+owner is taken from json key stubs {"inn": ..., "fio": ...}, certificates of .jks keys,
+or payer fixture otherwise.
+'''
+
+import io
+import os
+import json
+import logging
+import threading
+from time import sleep
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qs
+from socketserver import ThreadingMixIn
+from xml.etree import ElementTree as ET
+
+import cert_info
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SESSION_COOKIE = 'JSESSIONID'
+
+# synthetic data of mock pages, fields are not the ones of portal
+DATA_ROUTES = {
+    '/mock/payer': 'data/payer.json',
+    '/mock/ta': 'data/tax_account.json',
+    '/mock/reports': 'data/reports.json',
+}
+
+PAGE_ROUTES = {
+    '/': 'pages/index.html',
+    '/login': 'pages/login.html',
+    '/account': 'pages/account.html',
+    '/tax-account': 'pages/tax_account.html',
+    '/vreporting': 'pages/vreporting.html',
+    '/reporting/doc/new': 'pages/reporting_doc_new.html',
+}
+
+STATIC_TYPES = {
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+}
+
+CA_NAMES = [
+    'АЦСК ІДД ДФС',
+    'АЦСК АТ КБ «ПРИВАТБАНК»',
+    'АЦСК ТОВ "Центр сертифікації ключів "Україна"',
+]
+
+FORMS = {
+    'F01': [('F0103306', 'Податкова декларація платника єдиного податку - фізичної особи - '
+                         'підприємця')],
+    'F30': [('F3000511', 'Податкова декларація про майновий стан і доходи')],
+    'J02': [('J0200122', 'Податкова декларація з податку на додану вартість')],
+}
+
+DATE_FORMAT = '%d.%m.%Y'
+BUDGET_DETAIL_HEADERS = ['Дата', 'Нараховано', 'Сплачено', 'Повернуто', 'Пеня', 'Недоїмка',
+                         'Сальдо розрахунків']
+
+log = logging.getLogger('mock_cabinet')
+
+
+def load_fixture(name, fixtures_dir=FIXTURES_DIR):
+    with open(os.path.join(fixtures_dir, name), 'rb') as f:
+        return f.read()
+
+
+def read_key_owner(data, fixtures_dir=FIXTURES_DIR):
+    '''{fio, inn, org, org_code, issued, expires} of key file content'''
+    try:
+        owner = json.loads(data.decode('utf-8'))
+    except ValueError:
+        owner = None
+    if not isinstance(owner, dict):
+        owner = {}
+        try:
+            certs = cert_info.owner_certificates(cert_info.read_jks_certificates(data))
+        except cert_info.CertError:
+            certs = []
+        if certs:
+            fio, inn, org, org_code = cert_info.cert_owner_fields(certs[0])
+            owner = {'fio': fio, 'inn': inn, 'org': org, 'org_code': org_code,
+                     'issued': certs[0]['not_before'].strftime(DATE_FORMAT),
+                     'expires': certs[0]['not_after'].strftime(DATE_FORMAT)}
+    if not owner.get('fio'):
+        payer = json.loads(load_fixture(DATA_ROUTES['/mock/payer'], fixtures_dir))['payer']
+        owner.update(fio=payer['FULL_NAME'], inn=payer['TIN'])
+    now = datetime.now()
+    owner.setdefault('inn', '')
+    owner.setdefault('issued', (now - timedelta(days=365)).strftime(DATE_FORMAT))
+    owner.setdefault('expires', (now + timedelta(days=365)).strftime(DATE_FORMAT))
+    owner['inn'] = str(owner['inn'])
+    return owner
+
+
+def read_report_tin(data):
+    try:
+        return ET.fromstring(data).findtext('DECLARHEAD/TIN')
+    except ET.ParseError:
+        return None
+
+
+def budget_detail_row(item):
+    return [datetime.now().strftime(DATE_FORMAT)] + [
+        item[k] for k in ('SUM_NAR', 'SUM_SPL', 'SUM_POV', 'SUM_PENY', 'SUM_NED', 'SALDO')]
+
+
+def budget_report_xls(item):
+    '''Excel of budget status item laid out like cabinet one: headers in row 4, saldo in column 6'''
+    import xlwt  # needed only for item reports
+    wb = xlwt.Workbook(encoding='utf-8')
+    ws = wb.add_sheet('Стан розрахунків')
+    ws.write(0, 0, 'Стан розрахунків з бюджетом')
+    ws.write(1, 0, '{} {}'.format(item['NAME_TAX'], item['CODE_PAY']))
+    ws.write(2, 0, item['C_STI_NAME'])
+    ws.write(3, 0, 'Станом на')
+    ws.write(3, 1, datetime.now().strftime(DATE_FORMAT))
+    for col, value in enumerate(BUDGET_DETAIL_HEADERS):
+        ws.write(4, col, value)
+    for col, value in enumerate(budget_detail_row(item)):
+        ws.write(5, col, value)
+    stream = io.BytesIO()
+    wb.save(stream)
+    return stream.getvalue()
+
+
+class MockCabinetHandler(BaseHTTPRequestHandler):
+    fixtures_dir = FIXTURES_DIR
+    latency = 0  # seconds before every response
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def send(self, status, body=b'', content_type='application/json; charset=utf-8',
+             headers=()):
+        if self.latency:
+            sleep(self.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200, headers=()):
+        self.send(status, json.dumps(data, ensure_ascii=False).encode(), headers=headers)
+
+    def get_session(self):
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        return cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else None
+
+    def has_session(self):
+        return self.get_session() is not None
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def docs(self):
+        '''Documents created in session (keyed by inn), kept while server runs'''
+        return self.server.docs.setdefault(self.get_session(), [])
+
+    def budget_item(self, query):
+        for item in json.loads(load_fixture(DATA_ROUTES['/mock/ta'], self.fixtures_dir)):
+            if item['CODE_PAY'] == query.get('code') and item['C_STI_NAME'] == query.get('sti'):
+                return item
+        return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if url.path in PAGE_ROUTES:
+            return self.send(200, load_fixture(PAGE_ROUTES[url.path], self.fixtures_dir),
+                             'text/html; charset=utf-8')
+        if url.path.startswith('/static/'):
+            name = os.path.basename(url.path)
+            ext = os.path.splitext(name)[1]
+            if ext in STATIC_TYPES:
+                return self.send(200, load_fixture('pages/' + name, self.fixtures_dir),
+                                 STATIC_TYPES[ext])
+        if url.path == '/mock/ca':
+            return self.send_json(CA_NAMES)
+        if not self.has_session() and url.path.startswith('/mock/'):
+            return self.send(401, b'{"error": "unauthorized"}')
+        if url.path in DATA_ROUTES:
+            data = json.loads(load_fixture(DATA_ROUTES[url.path], self.fixtures_dir))
+            if url.path == '/mock/payer' and self.get_session().isdigit():
+                data['payer']['TIN'] = self.get_session()
+            if url.path == '/mock/reports':
+                data = [doc['row'] for doc in reversed(self.docs()) if doc['state'] == 'sent'] + data
+            year = query.get('year')
+            if year and isinstance(data, list):
+                data = [row for row in data if str(row.get('YEAR')) == year]
+            return self.send_json(data)
+        if url.path == '/mock/ta/detail':
+            item = self.budget_item(query)
+            return self.send_json([budget_detail_row(item)] if item else [])
+        if url.path == '/mock/ta/report':
+            item = self.budget_item(query)
+            if not item:
+                return self.send(404, b'{"error": "not found"}')
+            return self.send(200, budget_report_xls(item), 'application/vnd.ms-excel', headers=[
+                ('Content-Disposition', 'attachment; filename="pa.xls"')])
+        if url.path == '/mock/forms':
+            return self.send_json([{'code': code, 'name': name}
+                                   for code, name in FORMS.get(query.get('type'), [])])
+        if url.path == '/mock/docs':
+            return self.send_json([dict((k, v) for k, v in doc.items() if k != 'row')
+                                   for doc in reversed(self.docs())
+                                   if doc['state'] in ('saved', 'signed', 'sent')])
+        self.send(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        body = self.read_body()
+        if url.path == '/mock/cert':
+            return self.send_json(read_key_owner(body, self.fixtures_dir))
+        if url.path == '/mock/login':
+            owner = json.loads(body.decode('utf-8') or 'null') or {}
+            session = owner.get('inn') or owner.get('org_code') or 'anonymous'
+            return self.send_json({}, headers=[
+                ('Set-Cookie', '{}={}; Path=/'.format(SESSION_COOKIE, session))])
+        if not self.has_session():
+            return self.send(401, b'{"error": "unauthorized"}')
+
+        docs = self.docs()
+        if url.path == '/mock/doc/new':
+            data = json.loads(body.decode('utf-8'))
+            with self.server.lock:
+                doc = {'id': len(docs) + 1, 'code': data['code'], 'state': 'new',
+                       'date': datetime.now().strftime(DATE_FORMAT),
+                       'name': dict(sum(FORMS.values(), [])).get(data['code'], ''),
+                       'period': '{} {}'.format(data['year'], data['period']), 'receipt': ''}
+                docs.append(doc)
+            return self.send_json({'id': doc['id']})
+
+        action = url.path.rpartition('/')[2]
+        doc = next((doc for doc in docs if str(doc['id']) == query.get('id')), None)
+        if not url.path.startswith('/mock/doc/') or not doc:
+            return self.send(404, b'{"error": "not found"}')
+        transitions = {
+            'upload': ('new', 'uploaded'),
+            'check': ('uploaded', 'checked'),
+            'save': ('checked', 'saved'),
+            'sign': ('saved', 'signed'),
+            'send': ('signed', 'sent'),
+        }
+        if action not in transitions:
+            return self.send(404, b'{"error": "not found"}')
+        before, after = transitions[action]
+        if doc['state'] != before:
+            return self.send_json({'error': 'Документ не в стані {}'.format(before)}, 400)
+        if action == 'upload':
+            tin = read_report_tin(body)
+            if tin and tin != self.get_session():
+                return self.send_json({'error': 'ІПН звіту не відповідає платнику'}, 400)
+        if action == 'send':
+            doc['receipt'] = '1'
+            doc['row'] = {
+                'C_STI_NAME': 'ДПІ', 'C_DOC': doc['code'], 'REG_NUM': str(9100000000 + doc['id']),
+                'D_REG': doc['date'], 'PERIOD': doc['period'], 'ATTACHMENTS': '',
+                'STATUS_TEXT': 'Документ прийнято', 'YEAR': datetime.now().year,
+            }
+        doc['state'] = after
+        self.send_json({'id': doc['id'], 'state': after})
+
+
+class MockCabinetServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.docs = {}
+        self.lock = threading.Lock()
+
+
+def serve(host='127.0.0.1', port=0, fixtures_dir=FIXTURES_DIR, latency=0):
+    '''Start server in background thread, returns it (base url in server.url)'''
+    handler = type('Handler', (MockCabinetHandler,),
+                   {'fixtures_dir': fixtures_dir, 'latency': latency})
+    server = MockCabinetServer((host, port), handler)
+    server.url = 'http://{}:{}'.format(*server.server_address)
+    server.thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server.thread.start()
+    log.info('Mock cabinet on %s (latency %ss)', server.url, latency)
+    return server
+
+
+if __name__ == '__main__':
+    from sys import argv
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    latency = [float(arg.split('=', 1)[1]) for arg in argv if arg.startswith('--latency=')]
+    server = serve(port=int(args[0]) if args else 8000, latency=latency and latency[0] or 0)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
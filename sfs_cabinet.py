@@ -1,44 +1,130 @@
 #!/usr/bin/env python
 
-from time import sleep
+from time import sleep, time, perf_counter, monotonic
 from datetime import datetime
 import re
 import os
 import sys
 import glob
+import csv
+import json
+import random
+import shutil
+import sqlite3
+import hashlib
+import fnmatch
+import tempfile
 import logging
-from collections import OrderedDict
+import threading
+import importlib
+import importlib.util
+from functools import wraps, lru_cache
+from collections import OrderedDict, defaultdict
 from xml.etree import ElementTree as ET
+from urllib.parse import urlsplit
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
+# light, needed for except clauses
 from selenium.common.exceptions import (
-    NoSuchElementException, TimeoutException, ElementNotVisibleException)
-from selenium.webdriver.remote.remote_connection import LOGGER
-import xlrd
-import xlwt
-import xlutils.copy
-import choice
+    NoSuchElementException, TimeoutException, ElementNotVisibleException, WebDriverException)
 
 import arial10
+import cert_info
 
 try:
-    import glob2
-except ImportError:
-    glob2 = None
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 
-DEBUG = ('--debug' in sys.argv)
-logging.basicConfig(level=(logging.DEBUG if DEBUG else logging.INFO),
-                    format='%(asctime)s %(levelname)s %(message)s')
+class LazyImport:
+    """Module or it's attribute, imported on first attribute access or call"""
+
+    def __init__(self, module, attr=None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+
+def optional_import(module, attr=None):
+    # only finds module, so missing optional dependency costs nothing until used
+    try:
+        found = importlib.util.find_spec(module.split('.')[0])
+    except ValueError:
+        found = None
+    return LazyImport(module, attr) if found else None
+
+
+class LazyObject:
+    """Object made by factory on first attribute access, so it's built from current config"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def reset(self):
+        """Next access makes new object"""
+        self._target = None
+
+
+# heavy dependencies are imported on first use, so import and non-browser commands are fast
+webdriver = LazyImport('selenium.webdriver')
+By = LazyImport('selenium.webdriver.common.by', 'By')
+WebDriverWait = LazyImport('selenium.webdriver.support.ui', 'WebDriverWait')
+Select = LazyImport('selenium.webdriver.support.ui', 'Select')
+EC = LazyImport('selenium.webdriver.support.expected_conditions')
+xlrd = LazyImport('xlrd')
+xlwt = LazyImport('xlwt')
+xlutils_copy = LazyImport('xlutils.copy')
+choice = LazyImport('choice')
+
+inotify_simple = optional_import('inotify_simple')
+cryptography_fernet = optional_import('cryptography.fernet')
+pyarrow = optional_import('pyarrow')
+psutil = optional_import('psutil')
+pyarrow_parquet = optional_import('pyarrow.parquet')
 
-LOGGER.setLevel(logging.WARNING)
 
 log = logging.getLogger('sfs')
 
 
+def setup_logging():
+    logging.basicConfig(level=(logging.DEBUG if config.debug else logging.INFO),
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('selenium.webdriver.remote.remote_connection').setLevel(logging.WARNING)
+
+
+@lru_cache()
+def get_key_password():
+    """Default password of keys, read when first key is used"""
+    if not os.path.exists(KEY_PASSWORD_FILENAME):
+        raise RuntimeError('Keys password file not found: {}'.format(KEY_PASSWORD_FILENAME))
+    with open(KEY_PASSWORD_FILENAME) as f:
+        return f.read().strip()
+
+
 def get_relative_path(path):
     dirname = os.path.dirname(__file__)
     return os.path.abspath(os.path.join(dirname, path))
@@ -50,21 +136,75 @@ def maybe_remove(path):
 
 
 WAIT_TIMEOUT = 15
+ORPHAN_MIN_AGE = 60  # seconds, younger processes and profiles may be starting by other run
+SLOW_RESPONSE = 5  # seconds, page load or wait longer than this lowers concurrency
+CONCURRENCY_DECREASE = 0.5
 LAST_REPORT_STATUS_YEAR = None  # for current year
 LAST_REPORT_STATUS_YEAR = 2018  # delete this row for current year
 
-KEY_PASSWORD = open(get_relative_path('key_password')).read().strip()
+KEY_PASSWORD_FILENAME = get_relative_path('key_password')
 KEYS_FILENAME = get_relative_path('keys.xls')
+KEYS_JOURNAL_FILENAME = get_relative_path('keys.jsonl')  # imported to DB_FILENAME on first use
+DB_FILENAME = get_relative_path('sfs.db')
+METRICS_FILENAME = get_relative_path('metrics.jsonl')
+METRICS_SAMPLE_SIZE = 1000  # durations kept per step for percentiles
+# encrypts sessions saved in DB_FILENAME, kept out of working dir so it's not copied with sfs.db
+SESSION_KEY_FILENAME = os.path.join(
+    os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'sfs_cabinet',
+    'session_key')
+SESSION_TTL = 30 * 60  # seconds since session was used last time
+SESSION_RESTORE_PATH = '/favicon.ico'  # light page to set cookies on cabinet domain
+SESSION_COOKIE_FIELDS = ('name', 'value', 'path', 'domain', 'secure', 'httpOnly', 'expiry')
 
 INFO_FILENAME = get_relative_path('info.xls')
 REPORT_STATUS_FILENAME = get_relative_path('report_status.xls')
+REPORT_HISTORY_FILENAME = get_relative_path('report_history.xls')
+# typed tables of results: results.db, <table>.csv and <table>.parquet (with pyarrow)
+RESULTS_DIR = get_relative_path('./results')
+RESULTS_DB_FILENAME = os.path.join(RESULTS_DIR, 'results.db')
+EXPORT_FORMATS = 'sqlite,csv,parquet,xls'
+XLS_MAX_ROWS = 65536
+XLS_MAX_COLUMNS = 256
 
 KEYS_DIR = get_relative_path('./keys')
+KEY_PATTERNS = ('key-6.dat', '*.jks', '*.zs2')  # matched case-insensitive
 
 REPORTS_DIR = get_relative_path('./reports')
 OUTBOX_DIR = get_relative_path('./outbox')
 SENT_DIR = get_relative_path('./sent')
 
+OUTBOX_HEADER_FIELDS = ('TIN', 'C_DOC', 'C_DOC_SUB', 'C_DOC_VER', 'C_DOC_STAN', 'C_STI_ORIG',
+                        'PERIOD_MONTH', 'PERIOD_TYPE', 'PERIOD_YEAR')
+OUTBOX_HEADER_CHUNK_SIZE = 2048
+OUTBOX_POLL_INTERVAL = 5  # seconds, when inotify is not available
+OUTBOX_SETTLE_TIME = 2  # seconds since last write before file is queued
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_RETRY_DELAY = 60  # seconds, doubled on every attempt
+OUTBOX_MAX_RETRY_DELAY = 3600
+
+# Template chrome profile with warm http and code cache (see warm_profile),
+# every driver starts from it's own disposable clone
+PROFILE_DIR = get_relative_path('./chrome_profile')
+PROFILE_PREFIX = 'sfs-profile-'  # temporary profiles of started browsers
+# Never copied from template and wiped from it after warming,
+# so no cookies, credentials or site storage are shared between sessions
+PROFILE_PRIVATE_FILES = (
+    'Cookies', 'Cookies-journal', 'Login Data', 'Login Data-journal',
+    'Web Data', 'Web Data-journal', 'History', 'History-journal', 'Visited Links',
+    'Local Storage', 'Session Storage', 'Sessions', 'IndexedDB', 'Service Worker',
+    'Current Session', 'Current Tabs', 'Last Session', 'Last Tabs',
+    'SingletonLock', 'SingletonCookie', 'SingletonSocket',
+)
+# Completion of browser downloads, chromedriver logs events of Page domain only
+DOWNLOAD_EVENT = 'Page.downloadProgress'
+DOWNLOAD_EVENTS_INTERVAL = 0.1  # seconds between reads of performance log
+# download dirs of sessions without cloned profile, not touched by orphans cleanup
+DOWNLOAD_PREFIX = 'sfs-download-'
+# chromedriver endpoint of devtools commands, selenium 3 has no client method for it
+CDP_COMMAND = 'executeCdpCommand'
+CDP_COMMAND_ENDPOINT = ('POST', '/session/$sessionId/goog/cdp/execute')
+FICLONE = 0x40049409  # linux ioctl for copy-on-write file clone
+
 BUDGET_STATUS_CODES = OrderedDict((
     ('18050400', 'ЄП'),
     ('18050401', 'ЄП'),
@@ -75,29 +215,646 @@ BUDGET_STATUS_CODES = OrderedDict((
     ('18010700', 'Земля'),
     ('_', 'UNKNOWN'),
 ))
+# fields of every budget status item, in get_info they are suffixed by " =<code name>"
+BUDGET_STATUS_FIELDS = (
+    'ОДФС',
+    'Назва податку',
+    'Платіж',
+    'Код ЄДРПОУ отримувача',
+    'МФО',
+    'Назва отримувача',
+    'Бюджетний рахунок',
+    'Нараховано/зменшено',
+    'Сплачено до бюджету',
+    'Повернуто з бюджету',
+    'Пеня',
+    'Недоїмка',
+    'Переплата',
+    'Залишок несплаченої пені',
+    'saldo',
+)
+BUDGET_STATUS_AMOUNT_FIELDS = BUDGET_STATUS_FIELDS[7:]
+
+CABINET_URL = 'https://cabinet.sfs.gov.ua'  # can be pointed to local mock_cabinet.py
+
+
+class Config:
+    """
+    Flags and options of command line (see USAGE), parsed in main() by configure().
+    Module level config has defaults only, so importing module does not read sys.argv.
+    Raises ValueError on malformed option value.
+    """
+
+    def __init__(self, args=()):
+        self.args = list(args)
+        self.debug = self.flag('debug')
+        self.retry_failed = self.flag('retry-failed')
+        self.resend = self.flag('resend')  # send reports even if the same was sent already
+        self.resume = self.flag('resume')  # continue last report job instead of starting new one
+        self.fresh_login = self.flag('fresh-login')  # do not reuse saved cabinet sessions
+        self.saldo_from_report = self.flag('saldo-report')  # budget saldo from excel, not table
+        self.workers = int(self.option('workers', 1))  # max browsers, actual number is adaptive
+        self.rate = float(self.option('rate', 1))  # page loads per second of all workers
+        self.only = self.option('only')  # comma separated inns to (re)process
+        # days until section of inn is read again, 0 reads on every run
+        self.payer_ttl = float(self.option('payer-ttl', 30))  # registration data changes rarely
+        self.budget_ttl = float(self.option('budget-ttl', 1))
+        self.reports_ttl = float(self.option('reports-ttl', 1))
+        self.browser_sessions = int(self.option('browser-sessions', 20))  # cabinets before restart
+        self.browser_rss = int(self.option('browser-rss', 1024))  # MB of browser processes
+        # first year of documents read by get_report_history, next runs read since last year seen
+        self.history_from = int(self.option('history-from', datetime.now().year - 4))
+        self.session_key = self.option('session-key', SESSION_KEY_FILENAME)
+        self.export_formats = self.option('export', EXPORT_FORMATS).split(',')
+        cabinet_url = self.option('cabinet-url', CABINET_URL)
+        self.cabinet_url = os.environ.get('SFS_CABINET_URL', cabinet_url).rstrip('/')
+        # paths of commands
+        self.keys_dir = self.option('keys-dir', KEYS_DIR)
+        self.info_file = self.option('info-file', INFO_FILENAME)
+        self.report_status_file = self.option('report-status-file', REPORT_STATUS_FILENAME)
+        self.report_history_file = self.option('report-history-file', REPORT_HISTORY_FILENAME)
+        self.outbox_dir = self.option('outbox-dir', OUTBOX_DIR)
+        self.sent_dir = self.option('sent-dir', SENT_DIR)
+        self.idle_timeout = float(self.option('idle-timeout', 600))
+
+    def flag(self, name):
+        return '--' + name in self.args
+
+    def option(self, name, default=None):
+        prefix = '--{}='.format(name)
+        for arg in self.args:
+            if arg.startswith(prefix):
+                return arg[len(prefix):]
+        return default
+
+
+config = Config()
+
+
+def configure(args):
+    """Config of args for next commands, singletons depending on it are made again on use"""
+    global config
+    config = Config(args)
+    scheduler.reset()
+    supervisor.reset()
+    SessionStore._instance = None  # key file may be other
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'inn', 'outer_inn', 'started', 'error')
+
+    def __init__(self, metrics, name, inn):
+        self.metrics = metrics
+        self.name = name
+        self.inn = inn
+        self.error = None
+
+    def __enter__(self):
+        local = self.metrics.local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+            local.inn = None
+        local.stack.append(self.name)
+        self.outer_inn = local.inn
+        if self.inn is not None:
+            local.inn = self.inn
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = perf_counter() - self.started
+        local = self.metrics.local
+        if exc_type and not self.error:
+            self.error = exc_type.__name__
+        record = (time(), local.inn, '/'.join(local.stack), duration, self.error)
+        with self.metrics.lock:  # flush swaps records list under the lock
+            self.metrics.records.append(record)
+        local.stack.pop()
+        local.inn = self.outer_inn
+
+
+class _StepStats:
+    """Bounded aggregate of step durations, percentiles are taken from reservoir sample"""
+    __slots__ = ('count', 'errors', 'total', 'sample')
+
+    def __init__(self):
+        self.count = self.errors = 0
+        self.total = 0.0
+        self.sample = []
+
+    def add(self, duration, error):
+        self.count += 1
+        self.total += duration
+        if error:
+            self.errors += 1
+        if len(self.sample) < METRICS_SAMPLE_SIZE:
+            self.sample.append(duration)
+        else:
+            i = random.randrange(self.count)
+            if i < METRICS_SAMPLE_SIZE:
+                self.sample[i] = duration
+
+
+class Metrics:
+    """
+    Nested timing spans of browser steps. Spans are kept in memory as tuples until flush
+    writes them to jsonl, run summary (p50/p95 per step) is kept as bounded aggregates.
+    """
+
+    def __init__(self, filename=METRICS_FILENAME):
+        self.filename = filename
+        self.run = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        self.local = threading.local()
+        self.records = []
+        self.steps = defaultdict(_StepStats)
+        self.inns = OrderedDict()  # inn -> (duration, error) of last flush only
+        self.inns_count = 0
+        self.failed_inns = set()  # failed in their last span
+        self.lock = threading.Lock()
+
+    def span(self, name, inn=None):
+        return _Span(self, name, inn)
+
+    def flush(self):
+        with self.lock:
+            records, self.records = self.records, []
+            self.inns = OrderedDict()
+            if not records:
+                return
+            with open(self.filename, 'a', encoding='utf-8') as f:
+                for ts, inn, step, duration, error in records:
+                    self.steps[step].add(duration, error)
+                    if step == 'inn':
+                        self.inns[inn] = (duration, error)
+                        self.inns_count += 1
+                        if error:
+                            self.failed_inns.add(inn)
+                        else:
+                            self.failed_inns.discard(inn)
+                    f.write(json.dumps(OrderedDict((
+                        ('type', 'span'), ('run', self.run), ('ts', round(ts, 3)), ('inn', inn),
+                        ('step', step), ('duration', round(duration, 4)), ('error', error),
+                    )), ensure_ascii=False) + '\n')
+
+    def summary(self):
+        def percentile(values, p):
+            return values[min(len(values) - 1, int(len(values) * p))]
+
+        self.flush()
+        steps = OrderedDict()
+        for step in sorted(self.steps):
+            stats = self.steps[step]
+            values = sorted(stats.sample)
+            steps[step] = OrderedDict((
+                ('count', stats.count), ('errors', stats.errors),
+                ('total', round(stats.total, 3)),
+                ('p50', round(percentile(values, 0.5), 3)),
+                ('p95', round(percentile(values, 0.95), 3)),
+            ))
+        inns = OrderedDict((('count', self.inns_count),
+                            ('failed', sorted(str(inn) for inn in self.failed_inns))))
+        return OrderedDict((('type', 'summary'), ('run', self.run), ('steps', steps),
+                            ('inns', inns)))
+
+    def close(self):
+        summary = self.summary()
+        if not summary['steps']:
+            return
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(summary, ensure_ascii=False) + '\n')
+        log.info('Steps timing (count errors total p50 p95):')
+        for step, stat in summary['steps'].items():
+            log.info('  %-60s %5s %3s %9.3f %7.3f %7.3f', step, *stat.values())
+        inns = summary['inns']
+        if inns['count']:
+            log.info('Inns %s, failed %s %s', inns['count'], len(inns['failed']), inns['failed'])
+
+
+metrics = LazyObject(Metrics)
+
+
+def timed(name=None):
+    """Decorator running function in metrics span, metrics is not made until the call"""
+    def decorator(func):
+        span_name = name or func.__name__.lstrip('_')
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class AdaptiveScheduler:
+    """
+    Runs per-inn tasks in worker threads, number of concurrent tasks is AIMD controlled:
+    grows by one per window of fast responses, halves on error or slow response.
+    Portal requests of all workers are paced by one global rate budget.
+    """
+
+    def __init__(self, max_workers=1, min_workers=1, rate=1, slow=SLOW_RESPONSE):
+        self.max_workers = max(max_workers, min_workers)
+        self.min_workers = min_workers
+        self.rate = rate
+        self.slow = slow
+        self.limit = float(min_workers)
+        self.active = 0
+        self.decreased = 0
+        self.next_request = 0
+        self.cond = threading.Condition()
+        self.rate_lock = threading.Lock()
+
+    def throttle(self):
+        """Waits for request slot of global rate budget"""
+        if not self.rate:
+            return
+        with self.rate_lock:
+            now = monotonic()
+            self.next_request = max(self.next_request, now)
+            wait = self.next_request - now
+            self.next_request += 1 / self.rate
+        if wait > 0:
+            sleep(wait)
+
+    def observe(self, latency=None, error=False):
+        with self.cond:
+            before = int(self.limit)
+            if error or (latency is not None and latency > self.slow):
+                # in-flight tasks report the same congestion, so one decrease per slow period
+                if monotonic() - self.decreased > self.slow:
+                    self.limit = max(self.min_workers, self.limit * CONCURRENCY_DECREASE)
+                    self.decreased = monotonic()
+            else:
+                self.limit = min(self.max_workers, self.limit + 1 / self.limit)
+            if int(self.limit) != before:
+                log.info('Concurrency %s -> %s', before, int(self.limit))
+                self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def _call(self, func, item, failed):
+        result = func(item)
+        if self.max_workers > 1:
+            self.observe(error=bool(failed and failed(result)))
+        return result
+
+    def map(self, func, items, failed=None):
+        """[func(item), ...], failed(result) tells if task failed"""
+        items = list(items)
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [self._call(func, item, failed) for item in items]
+
+        results = [None] * len(items)
+        errors = []
+        indexes = iter(range(len(items)))
+        lock = threading.Lock()
+
+        def worker():
+            while not errors:
+                with lock:
+                    i = next(indexes, None)
+                if i is None:
+                    return
+                self.acquire()
+                try:
+                    results[i] = self._call(func, items[i], failed)
+                except Exception as e:
+                    log.exception('Worker failed on %s', items[i])
+                    errors.append(e)
+                finally:
+                    self.release()
+
+        threads = [threading.Thread(target=worker, name='worker-{}'.format(n), daemon=True)
+                   for n in range(min(self.max_workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+scheduler = LazyObject(lambda: AdaptiveScheduler(config.workers, rate=config.rate))
+
+
+def _clone_file(src, dst):
+    if fcntl:
+        # copy-on-write clone on filesystems supporting it (btrfs, xfs)
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def clone_profile(template_dir=PROFILE_DIR):
+    # empty profile without template, so browser is found by profile prefix anyway
+    profile_dir = os.path.join(tempfile.mkdtemp(prefix=PROFILE_PREFIX), 'profile')
+    if not os.path.exists(template_dir):
+        return profile_dir
+    shutil.copytree(template_dir, profile_dir, copy_function=_clone_file,
+                    ignore=shutil.ignore_patterns(*PROFILE_PRIVATE_FILES))
+    log.debug('cloned profile %s to %s', template_dir, profile_dir)
+    return profile_dir
+
+
+def wipe_profile_private(profile_dir):
+    for root, dirs, files in os.walk(profile_dir):
+        for name in dirs + files:
+            if name in PROFILE_PRIVATE_FILES:
+                path = os.path.join(root, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+
+# Page extractors walking DOM in browser, so page is read in one webdriver round-trip
+PAYER_INFO_SCRIPT = '''
+return Array.prototype.map.call(document.querySelectorAll('p-accordiontab'), function (group) {
+    var header = group.querySelector('.ui-accordion-header');
+    return {
+        name: header ? header.innerText.trim() : '',
+        rows: Array.prototype.map.call(
+            group.querySelectorAll('div.row.ng-star-inserted'), function (row) {
+                return Array.prototype.map.call(row.querySelectorAll('label'), function (e) {
+                    return e.innerText.trim();
+                });
+            })
+    };
+});
+'''
+
+# [[label, value], ...] per item, payment buttons rows and rows without label are skipped
+_BUDGET_STATUS_ROWS_JS = '''
+function budgetStatusRows(group) {
+    var rows = [];
+    Array.prototype.forEach.call(group.querySelectorAll('div.row'), function (row) {
+        if (row.innerText.trim().indexOf('Сплатити') === 0) {
+            return;
+        }
+        var label = row.querySelector('label');
+        if (!label || !label.innerText.trim()) {
+            return;
+        }
+        var value = row.querySelector('span') || row.querySelector('.sum');
+        rows.push([label.innerText.trim(), value ? value.innerText.trim() : null]);
+    });
+    return rows;
+}
+'''
+
+SESSION_STORAGE_SCRIPT = '''
+return {local: Object.assign({}, window.localStorage),
+        session: Object.assign({}, window.sessionStorage)};
+'''
+
+SESSION_RESTORE_SCRIPT = '''
+var storage = arguments[0];
+[['local', localStorage], ['session', sessionStorage]].forEach(function (pair) {
+    Object.keys(storage[pair[0]]).forEach(function (k) { pair[1].setItem(k, storage[pair[0]][k]); });
+});
+'''
+
+BUDGET_STATUS_ITEMS_SCRIPT = _BUDGET_STATUS_ROWS_JS + '''
+return Array.prototype.map.call(document.querySelectorAll('div.row.data-item'), budgetStatusRows);
+'''
+
+# Item element by payment code (arguments[0]) and ОДФС (arguments[1])
+BUDGET_STATUS_ITEM_SCRIPT = _BUDGET_STATUS_ROWS_JS + '''
+var groups = document.querySelectorAll('div.row.data-item');
+for (var i = 0; i < groups.length; i++) {
+    var values = {};
+    budgetStatusRows(groups[i]).forEach(function (row) { values[row[0]] = row[1]; });
+    if ((values['Платіж'] || '').split(' ')[1] === arguments[0] &&
+            values['ОДФС'] === arguments[1]) {
+        return groups[i];
+    }
+}
+return null;
+'''
+
+# [headers, [[cell, ...], ...]] of vreporting documents table page
+REPORT_ROWS_SCRIPT = '''
+function texts(elements) {
+    return Array.prototype.map.call(elements, function (e) { return e.innerText.trim(); });
+}
+return [texts(document.querySelectorAll('thead tr th')),
+        Array.prototype.map.call(document.querySelectorAll('tbody tr'), function (row) {
+            return texts(row.querySelectorAll('td'));
+        })];
+'''
+
+SESSION_CLEAR_SCRIPT = '''
+try {
+    sessionStorage.clear();
+} catch (e) {}
+'''
+
+
+def url_origin(url):
+    """scheme://host[:port] of http(s) url, None for about:, data: and others"""
+    parts = urlsplit(url)
+    if parts.scheme in ('http', 'https') and parts.netloc:
+        return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+def frame_origins(frame_tree):
+    rv = {url_origin(frame_tree['frame'].get('url', ''))}
+    for child in frame_tree.get('childFrames', ()):
+        rv |= frame_origins(child)
+    return rv
+
+
+class DriverPool:
+    """
+    Started browsers kept for next cabinets (of other inns or commands), so browser and
+    chromedriver start once per worker. On return browser is reset through devtools:
+    all cookies, storage of every visited origin (local, indexeddb, cache, service workers)
+    and http cache are cleared.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = []  # (driver, profile_dir, profile_dir_is_clone)
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            return self.idle.pop() if self.idle else None
+
+    def put(self, driver, profile_dir, profile_dir_is_clone, origins=()):
+        """False if browser is not kept (pool is full or browser is broken), caller quits it"""
+        with self.lock:
+            if len(self.idle) >= self.size:
+                return False
+        try:
+            self.reset(driver, origins)
+        except WebDriverException as e:
+            log.warning('Browser is not reused: %s', repr(e))
+            return False
+        with self.lock:
+            self.idle.append((driver, profile_dir, profile_dir_is_clone))
+        return True
+
+    @staticmethod
+    def reset(driver, origins):
+        origins = set(origins) | {url_origin(config.cabinet_url)}
+        # frames of current page (iframes of signing widgets are not opened by get)
+        origins |= frame_origins(execute_cdp(driver, 'Page.getFrameTree', {})['frameTree'])
+        for cookie in execute_cdp(driver, 'Network.getAllCookies', {})['cookies']:
+            domain = cookie['domain'].lstrip('.')
+            origins.update(('http://' + domain, 'https://' + domain))
+        origins.discard(None)
+        # session storage is per tab and not a part of storage types, it's cleared on page
+        if not driver.current_url.startswith(config.cabinet_url + '/'):
+            driver.get(config.cabinet_url + SESSION_RESTORE_PATH)
+        driver.execute_script(SESSION_CLEAR_SCRIPT)
+        driver.get('about:blank')
+        execute_cdp(driver, 'Network.clearBrowserCookies', {})
+        for origin in sorted(origins):
+            execute_cdp(driver, 'Storage.clearDataForOrigin', {
+                'origin': origin, 'storageTypes': 'all'})
+        execute_cdp(driver, 'Network.clearBrowserCache', {})
+        log.debug('Browser reset, origins: %s', ', '.join(sorted(origins)))
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for driver, profile_dir, profile_dir_is_clone in idle:
+            quit_driver(driver, profile_dir, profile_dir_is_clone)
+
+
+def quit_driver(driver, profile_dir, profile_dir_is_clone):
+    supervisor.quit(driver)
+    if profile_dir_is_clone:
+        shutil.rmtree(os.path.dirname(profile_dir), ignore_errors=True)
+
+
+def execute_cdp(driver, cmd, params):
+    driver.command_executor._commands.setdefault(CDP_COMMAND, CDP_COMMAND_ENDPOINT)
+    return driver.execute(CDP_COMMAND, {'cmd': cmd, 'params': params})['value']
+
+
+driver_pool = None  # DriverPool of command run, browser per cabinet without it
 
 
 class SeleniumHelperMixin:
-    def create_driver(self):
+    profile_dir = None
+    profile_dir_is_clone = False
+    pooled = False
+    download_dir = None
+    visited_origins = frozenset()
+
+    @timed()
+    def create_driver(self, profile_dir=None):
+        # only browsers of cloned profiles are pooled, explicit profile is owned by caller
+        self.pooled = driver_pool is not None and not profile_dir
+        pooled_driver = self.pooled and driver_pool.take()
+        if pooled_driver:
+            driver, self.profile_dir, self.profile_dir_is_clone = pooled_driver
+            supervisor.start_session(driver)
+            return driver
         chrome_options = webdriver.ChromeOptions()
         chrome_options.add_argument('--lang=en-US')
+        if profile_dir:
+            self.profile_dir = profile_dir
+        else:
+            self.profile_dir = clone_profile()
+            self.profile_dir_is_clone = bool(self.profile_dir)
+        if self.profile_dir:
+            chrome_options.add_argument('--user-data-dir=' + self.profile_dir)
         chrome_options.add_experimental_option('prefs', {
             'download.default_directory': self.reports_dir,
             'safebrowsing.enabled': True,
         })
+        if config.saldo_from_report:
+            # download events of devtools are read from performance log (see download),
+            # it's kept by chromedriver until read, so it's enabled only when downloads are used
+            chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+            chrome_options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': False})
         driver = webdriver.Chrome(chrome_options=chrome_options)
+        supervisor.register(driver)
+        supervisor.start_session(driver)
         driver.set_page_load_timeout(WAIT_TIMEOUT)
         # maybe move out from screen?
         # driver.set_window_position(0, 0)
         # driver.set_window_size(800, 600)
         return driver
 
+    @timed()
     def get(self, url):
         log.debug('get %s', url)
-        self.driver.get(url)
-
+        self.visited_origins = self.visited_origins | {url_origin(url)}
+        scheduler.throttle()
+        started = perf_counter()
+        try:
+            self.driver.get(url)
+        except TimeoutException:
+            scheduler.observe(error=True)
+            raise
+        scheduler.observe(perf_counter() - started)
+
+    def _start_downloads(self):
+        # own directory per session, so files of parallel workers never collide;
+        # next to cloned profile, so it is removed with it (or as orphan after crash)
+        if self.profile_dir_is_clone:
+            self.download_dir = tempfile.mkdtemp(
+                prefix='downloads-', dir=os.path.dirname(self.profile_dir))
+        else:
+            self.download_dir = tempfile.mkdtemp(prefix=DOWNLOAD_PREFIX)
+        execute_cdp(self.driver, 'Browser.setDownloadBehavior', {
+            'behavior': 'allowAndName', 'downloadPath': self.download_dir, 'eventsEnabled': True})
+
+    @timed()
+    def download(self, start):
+        """Content of file downloaded by start(), completion is signalled by devtools event"""
+        if not self.download_dir:
+            self._start_downloads()
+        self.driver.get_log('performance')  # events of pages before
+        start()
+        deadline = monotonic() + WAIT_TIMEOUT
+        while monotonic() < deadline:
+            for entry in self.driver.get_log('performance'):
+                event = json.loads(entry['message'])['message']
+                if event.get('method') != DOWNLOAD_EVENT:
+                    continue
+                state = event['params'].get('state')
+                if state == 'canceled':
+                    raise RuntimeError('Download canceled')
+                if state == 'completed':
+                    # allowAndName saves file under download guid instead of suggested name
+                    path = os.path.join(self.download_dir, event['params']['guid'])
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    os.remove(path)
+                    return data
+            sleep(DOWNLOAD_EVENTS_INTERVAL)
+        raise TimeoutException('Download not completed in {}s'.format(WAIT_TIMEOUT))
+
+    @timed()
     def quit(self):
-        self.driver.quit()
+        if self.download_dir:
+            shutil.rmtree(self.download_dir, ignore_errors=True)
+            self.download_dir = None
+        if self.pooled and not supervisor.should_recycle(self.driver) and driver_pool.put(
+                self.driver, self.profile_dir, self.profile_dir_is_clone, self.visited_origins):
+            return
+        quit_driver(self.driver, self.profile_dir, self.profile_dir_is_clone)
 
     def get_element(self, selector, wait=False):
         if wait:
@@ -125,24 +882,30 @@ class SeleniumHelperMixin:
             )
         return self.driver.find_element_by_xpath(xpath)
 
+    @timed()
     def wait_presence(self, selector):
         log.debug('waiting presence %s', selector)
-        return WebDriverWait(self.driver, WAIT_TIMEOUT).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, selector)),
-        )
+        return self._wait(EC.presence_of_element_located((By.CSS_SELECTOR, selector)))
 
+    @timed()
     def wait_invisible(self, selector):
         log.debug('waiting invisible %s', selector)
-        return WebDriverWait(self.driver, WAIT_TIMEOUT).until(
-            EC.invisibility_of_element_located((By.CSS_SELECTOR, selector)),
-        )
+        return self._wait(EC.invisibility_of_element_located((By.CSS_SELECTOR, selector)))
 
+    @timed()
     def wait_visible(self, selector):
         log.debug('waiting visible %s', selector)
-        return WebDriverWait(self.driver, WAIT_TIMEOUT).until(
-            EC.visibility_of_element_located((By.CSS_SELECTOR, selector)),
-        )
+        return self._wait(EC.visibility_of_element_located((By.CSS_SELECTOR, selector)))
+
+    def _wait(self, condition):
+        # successful waits are mostly portal xhr responses, so they are latency samples;
+        # timeouts are expected in some flows and are not counted as errors
+        started = perf_counter()
+        rv = WebDriverWait(self.driver, WAIT_TIMEOUT).until(condition)
+        scheduler.observe(perf_counter() - started)
+        return rv
 
+    @timed()
     def wait_callback(self, callback):
         log.debug('waiting callback')
         sleeped = 0
@@ -152,10 +915,12 @@ class SeleniumHelperMixin:
             sleeped += 1
             sleep(1)
 
+    @timed()
     def send_keys(self, selector, keys):
         log.debug('sending keys %s', selector)
         self.driver.find_element_by_css_selector(selector).send_keys(keys)
 
+    @timed()
     def click(self, selector):
         log.debug('clicking %s', selector)
         element = self.driver.find_element_by_css_selector(selector)
@@ -176,22 +941,58 @@ class SeleniumHelperMixin:
         self.wait_invisible(selector)
 
 
+def format_amount(value):
+    """Amount as cabinet pages render it, like '-1 234,56'"""
+    return '{:,.2f}'.format(value).replace(',', ' ').replace('.', ',')
+
+
+def resolve_cert_owner(fio, inn, org, org_code, info):
+    if not inn:
+        # It's possible that in some types of privat keys INN only in organization field
+        assert fio == org, 'certInfo fio/organization unmatch: "{}" != "{}"'.format(fio, org)
+        inn = org_code
+    assert inn, 'No INN from certInfo matched: {}'.format(info)
+    return int(inn), fio
+
+
+def read_offline_cert(key_path):
+    # (inn, fio, expires) from certificates in key container or next to it, None if unknown
+    try:
+        certs = cert_info.key_certificates(key_path, KEY_PATTERNS)
+    except (OSError, ValueError) as e:  # CertError is ValueError
+        log.debug('Could not read certificates for %s: %r', key_path, e)
+        return None
+    owners = set()
+    for cert in certs:
+        fio, inn, org, org_code = cert_info.cert_owner_fields(cert)
+        try:
+            inn, fio = resolve_cert_owner(fio, inn, org, org_code, cert['subject'])
+        except AssertionError as e:
+            log.debug('Skipping certificate for %s: %s', key_path, e)
+            continue
+        owners.add((inn, fio, cert['not_after'].strftime('%d.%m.%Y')))
+    if len(set(owner[:2] for owner in owners)) != 1:
+        return None  # no certificates or certificates of different owners near key
+    return max(owners, key=lambda owner: datetime.strptime(owner[2], '%d.%m.%Y'))
+
+
 class Cabinet(SeleniumHelperMixin):
     inn = fio = None
+    send_clicked = False  # report may be accepted by cabinet, even if sending failed after
 
-    def __init__(self, driver=None):
+    def __init__(self, driver=None, profile_dir=None):
         self.reports_dir = REPORTS_DIR
         self.outbox_dir = OUTBOX_DIR
         self.sent_dir = SENT_DIR
-        self.budget_status_report_default_path = os.path.join(self.reports_dir, 'pa.xlsx')
 
         for dir_ in [self.reports_dir, self.outbox_dir, self.sent_dir]:
             if not os.path.exists(dir_):
                 os.mkdir(dir_)
 
-        self.driver = driver or self.create_driver()
+        self.driver = driver or self.create_driver(profile_dir)
 
-    def enter_cert(self, cert_path, password=KEY_PASSWORD):
+    @timed()
+    def enter_cert(self, cert_path, password=None):
         for pwd_filename in [cert_path + '.txt', cert_path[:cert_path.rfind('.')] + '.txt']:
             if os.path.exists(pwd_filename):
                 password = open(pwd_filename).read().strip()
@@ -203,6 +1004,8 @@ class Cabinet(SeleniumHelperMixin):
                 if not password:
                     # Treat filename as password if empty
                     password = os.path.basename(txt_files[0])[:-4]
+        if password is None:
+            password = get_key_password()
         if '\n' in password:
             # Treat second line as CA
             password, ca_name = password.split('\n')
@@ -242,22 +1045,22 @@ class Cabinet(SeleniumHelperMixin):
         if not match:
             raise RuntimeError('Unmatched certInfo text: {}'.format(info))
         fio, inn, expires = match.groups()
+        org = org_code = None
         if not inn:
-            # It's possible that in some types of privat keys INN only in organization field
             match = re.match('.*^Організація : (.+) \((\d+)\)$',
                              info, re.MULTILINE | re.DOTALL)
             if not match:
                 raise RuntimeError('Unmatched certInfo organization text: {}'.format(info))
-            fio_, inn = match.groups()
-            assert fio == fio_, 'certInfo fio/organization unmatch: "{}" != "{}"'.format(fio, fio_)
-        assert inn, 'No INN from certInfo matched: {}'.format(info)
+            org, org_code = match.groups()
+        inn, fio = resolve_cert_owner(fio, inn, org, org_code, info)
         log.debug('inn=%s, fio=%s expires=%s', inn, fio, expires)
-        return int(inn), fio, expires
+        return inn, fio, expires
 
-    def pre_login_cert(self, cert_path, password=KEY_PASSWORD):
+    @timed()
+    def pre_login_cert(self, cert_path, password=None):
 
         # self.get('https://cabinet.sfs.gov.ua/cabinet/faces/login.jspx')
-        self.get('https://cabinet.sfs.gov.ua/login')
+        self.get(config.cabinet_url + '/login')
 
         # self.wait_presence('.blockUI.blockOverlay')
         self.wait_invisible('.blockUI.blockOverlay')  # TODO: already renamed?
@@ -265,30 +1068,85 @@ class Cabinet(SeleniumHelperMixin):
 
         return self.enter_cert(cert_path, password)
 
-    def login(self, key_path, password=KEY_PASSWORD):
+    @timed()
+    def restore_session(self, inn):
+        """Restores saved session of inn if portal still accepts it"""
+        store = SessionStore.get()
+        session = store and store.load(inn)
+        if not session:
+            return False
+        self.get(config.cabinet_url + SESSION_RESTORE_PATH)
+        self.driver.delete_all_cookies()
+        for cookie in session['cookies']:
+            self.driver.add_cookie(dict((k, v) for k, v in cookie.items()
+                                        if k in SESSION_COOKIE_FIELDS))
+        self.driver.execute_script(SESSION_RESTORE_SCRIPT, session['storage'])
+        # account page shows payer number only for accepted session
+        owner = self.get_owner_inn()
+        if owner != inn:
+            log.info('Saved session of %s is not accepted (owner %s), logging in', inn, owner)
+            store.remove(inn)
+            self.driver.delete_all_cookies()
+            return False
+        self.inn, self.fio = inn, session['fio']
+        store.touch(inn)
+        log.info('session restored inn=%s fio=%s', self.inn, self.fio)
+        return True
+
+    def get_owner_inn(self):
+        """Inn of logged in payer as account page shows it, None if it's not shown"""
+        self.get(config.cabinet_url + '/account')
+        if not self.driver.current_url.startswith(config.cabinet_url + '/account'):
+            return None  # redirected to login
+        try:
+            self.wait_visible('p-accordiontab')
+        except TimeoutException:
+            return None
+        for group in self.driver.execute_script(PAYER_INFO_SCRIPT):
+            for label, value in group['rows']:
+                if label == 'Податковий номер':
+                    return int(value) if value.strip().isdigit() else None
+        return None
+
+    def save_session(self):
+        store = SessionStore.get()
+        if store:
+            store.save(self.inn, self.fio, self.driver.get_cookies(),
+                       self.driver.execute_script(SESSION_STORAGE_SCRIPT))
+
+    @timed()
+    def login(self, key_path, password=None, inn=None):
+        # inn of key is known from keys store, so saved session may be used without key
+        if inn and not config.fresh_login and self.restore_session(inn):
+            return
         self.inn, self.fio, _ = self.pre_login_cert(key_path, password)
 
         login = self.driver.find_elements_by_css_selector('button[title=Увійти]')[-1]
         login.click()
-        sleep(0.2)
-        try:
-            self.wait_invisible('.ui-blockui-document')
-        except TimeoutException:
-            if self.driver.current_url != 'https://cabinet.sfs.gov.ua/':
-                raise
-            # in other case we wasn't waiting because of redirect
-
-        log.info('logged in inn=%s fio=%s', self.inn, self.fio)
-        sleep(2)  # sleeping after login to wait redirect to new page before new get
+        with metrics.span('redirect'):
+            sleep(0.2)
+            try:
+                self.wait_invisible('.ui-blockui-document')
+            except TimeoutException:
+                if self.driver.current_url != config.cabinet_url + '/':
+                    raise
+                # in other case we wasn't waiting because of redirect
+
+            log.info('logged in inn=%s fio=%s', self.inn, self.fio)
+            sleep(2)  # sleeping after login to wait redirect to new page before new get
         # self.driver.execute_script("window.stop()")  # now working
+        self.save_session()
 
+    @timed()
     def get_payer_info(self):
-        self.get('https://cabinet.sfs.gov.ua/account')
+        self.get(config.cabinet_url + '/account')
         self.wait_visible('p-accordiontab')
         rv = OrderedDict()
 
-        for group in self.driver.find_elements_by_css_selector('p-accordiontab'):
-            group_name = group.find_element_by_css_selector('.ui-accordion-header').text.strip()
+        with metrics.span('extract'):
+            groups = self.driver.execute_script(PAYER_INFO_SCRIPT)
+        for group in groups:
+            group_name = group['name']
             if group_name == 'Відомості з Реєстру осіб, які здійснюють операції з товаром':
                 label_postfix = ' =Товари'
             elif group_name == 'Дані про реєстрацію платником ЄСВ':
@@ -296,8 +1154,8 @@ class Cabinet(SeleniumHelperMixin):
             else:
                 label_postfix = None
 
-            for row in group.find_elements_by_css_selector('div.row.ng-star-inserted'):
-                label, value = [e.text.strip() for e in row.find_elements_by_css_selector('label')]
+            for labels in group['rows']:
+                label, value = labels
                 if label_postfix:
                     label += label_postfix
                 assert label not in rv, 'Duplicate field in "{}": "{}"'.format(group_name, label)
@@ -305,18 +1163,25 @@ class Cabinet(SeleniumHelperMixin):
 
         return rv
 
+    @timed()
     def get_budget_status(self, odfs=None):
-        rv = {}
-        for i, data in enumerate(tuple(self.get_budget_status_items())):
+        # Items are keyed by payment code and ОДФС, all saldo are read on the same page visit
+        items = OrderedDict()
+        for data in self.get_budget_status_items():
             pay = data['Платіж'].split(' ')[1]
             if pay in ('18050400', '18050401', '71040000') and odfs and odfs != data['ОДФС']:
                 continue
-            data['saldo'] = self.get_budget_status_saldo(data, i)
+            items[(pay, data['ОДФС'])] = data
+
+        rv = {}
+        for (pay, item_odfs), data in items.items():
+            data['saldo'] = self.get_budget_status_saldo(pay, item_odfs)
             rv[BUDGET_STATUS_CODES.get(pay, tuple(BUDGET_STATUS_CODES.values())[-1])] = data
         return rv
 
+    @timed()
     def _open_budget_status_page(self):
-        self.get('https://cabinet.sfs.gov.ua/tax-account')
+        self.get(config.cabinet_url + '/tax-account')
         self.wait_visible('div.ui-datalist-content')
         # self.wait_invisible('.ui-blockui-document')  # NOTE: not sure about
         try:
@@ -328,28 +1193,19 @@ class Cabinet(SeleniumHelperMixin):
     def get_budget_status_items(self):
         if not self._open_budget_status_page():
             return
-        for group in self.driver.find_elements_by_css_selector('div.row.data-item'):
+        with metrics.span('extract'):
+            groups = self.driver.execute_script(BUDGET_STATUS_ITEMS_SCRIPT)
+        for group in groups:
             data = OrderedDict()
-            for row in group.find_elements_by_css_selector('div.row'):
-                if row.text.strip().startswith('Сплатити'):
-                    continue
-                try:
-                    label = row.find_element_by_css_selector('label').text.strip()
-                    if not label:
-                        continue
-                except NoSuchElementException:
-                    # Seems like this is payment buttons
-                    continue
-                try:
-                    value = row.find_element_by_css_selector('span').text.strip()
-                except NoSuchElementException:
-                    value = row.find_element_by_css_selector('.sum').text.strip()
+            for label, value in group:
+                if value is None:
+                    raise NoSuchElementException('No value for {}'.format(label))
                 assert label not in data, 'Duplicate: {}'.format(label)
                 data.update({label: value})
             yield data
 
-    def _parse_budget_status_report_saldo(self, filename):
-        wb = xlrd.open_workbook(filename)
+    def _parse_budget_status_report_saldo(self, data):
+        wb = xlrd.open_workbook(file_contents=data)
         ws = wb.sheet_by_index(0)
         # status_date_text = ws.row(3)[1].value
         assert ws.row(4)[6].value == 'Сальдо розрахунків', 'Unexpected report format'
@@ -360,73 +1216,127 @@ class Cabinet(SeleniumHelperMixin):
         # wb.close()
         return saldo
 
-    def get_budget_status_saldo(self, data, index):
-        assert self._open_budget_status_page()
-        # Actually it's not safe at all, because data may have changed since we got index,
-        # but fuck it
-        group = self.driver.find_elements_by_css_selector('div.row.data-item')[index]
+    @timed()
+    def get_budget_status_saldo(self, pay, odfs):
+        # Expecting tax-account page opened already by get_budget_status_items
+        group = self.driver.execute_script(BUDGET_STATUS_ITEM_SCRIPT, pay, odfs)
+        assert group, 'Budget status item not found: {} {}'.format(pay, odfs)
         group.click()
 
         self.wait_visible('i.fa-file-excel-o')
         self.wait_invisible('i.fa-spin')
         self.wait_invisible('.ui-table-loading')
 
-        # For some reason excel table show wrong results some time, so get this from interface
-        tds = self.driver.find_elements_by_css_selector('div.patable.ui-table table td')
-        if tds:
-            return tds[6].text or 0
+        if config.saldo_from_report:
+            saldo = self._parse_budget_status_report_saldo(self.download(
+                lambda: self.get_element('i.fa-file-excel-o').click()))
+            if isinstance(saldo, float):
+                saldo = format_amount(saldo)  # as table cell shows it
         else:
-            return 0
-
-        # This is old functionality
-        # maybe_remove(self.budget_status_report_default_path)
-        # self.get_element('i.fa-file-excel-o').click()
-        # def check_path():
-        #     return os.path.exists(self.budget_status_report_default_path)
-        # self.wait_callback(check_path)
+            # For some reason excel table show wrong results some time, so get this from interface
+            tds = self.driver.find_elements_by_css_selector('div.patable.ui-table table td')
+            saldo = tds and tds[6].text or 0
 
-        # filename = str(self.inn) + '_' + data['Платіж'].replace(' ', '') + '.xlsx'
-        # filename = os.path.join(self.reports_dir, filename)
-        # maybe_remove(filename)
-        # os.rename(self.budget_status_report_default_path, filename)
-
-        # return self._parse_budget_status_report_saldo(filename)
+        # collapsing item back, so next item table is not mixed with this one
+        group.click()
+        try:
+            self.wait_invisible('div.patable')
+        except TimeoutException:
+            log.warning('Budget status item not collapsed, reopening page')
+            assert self._open_budget_status_page()
+        return saldo
 
-    def get_info(self):
-        rv = self.get_payer_info()
-        odfs = rv['Найменування ДПІ за основним місцем обліку']
+    def get_budget_status_fields(self, odfs=None):
+        rv = OrderedDict()
         for code, data in self.get_budget_status(odfs).items():
             for k, v in data.items():
                 rv[k + ' =' + code] = v
         return rv
 
-    def get_last_report_status(self):
-        self.get('https://cabinet.sfs.gov.ua/vreporting')
+    @timed()
+    def get_info(self):
+        rv = self.get_payer_info()
+        rv.update(self.get_budget_status_fields(rv['Найменування ДПІ за основним місцем обліку']))
+        return rv
+
+    def get_section(self, section, record):
+        """Fields of report section, record has fields of previous sections (read or saved)"""
+        if section == 'payer':
+            return self.get_payer_info()
+        if section == 'budget':
+            return self.get_budget_status_fields(
+                record['Найменування ДПІ за основним місцем обліку'])
+        if section == 'reports':
+            return self.get_last_report_status()
+        raise ValueError('Unknown section: {}'.format(section))
+
+    @timed()
+    def _show_reports(self, year=None):
+        # page is kept open between years, documents are reloaded by choosing type again
+        if not self.driver.current_url.startswith(config.cabinet_url + '/vreporting'):
+            self.get(config.cabinet_url + '/vreporting')
         report_type = self.get_element('.sticky-top .col-lg-12 .ui-dropdown-trigger', wait=True)
 
-        if LAST_REPORT_STATUS_YEAR:
-            year = self.driver.find_element_by_css_selector('input.ui-inputtext[type=text][size="10"]')
-            year.clear()
-            year.send_keys(str(LAST_REPORT_STATUS_YEAR))
+        if year:
+            year_input = self.driver.find_element_by_css_selector(
+                'input.ui-inputtext[type=text][size="10"]')
+            year_input.clear()
+            year_input.send_keys(str(year))
 
         report_type.click()
         menu = self.driver.find_element_by_css_selector('ul.ui-dropdown-items')
         menu.find_element_by_xpath("./li/span[text() = '{}']".format('Всі')).click()
         self.wait_invisible('ul.ui-dropdown-items')
         self.wait_invisible('i.fa-spin.fa-circle-o-notch')
-        headers = [td.text for td in self.driver.find_elements_by_css_selector('thead tr th')]
+
+    @timed()
+    def get_last_report_status(self):
+        self._show_reports(LAST_REPORT_STATUS_YEAR)
+        with metrics.span('extract'):
+            headers = [td.text for td in self.driver.find_elements_by_css_selector('thead tr th')]
+            values = [td.text for td in
+                      self.driver.find_elements_by_css_selector('tbody tr:nth-child(1) td')]
         assert headers[-1] == ''
         headers[-1] = 'Comment'
 
-        values = [td.text for td in
-                  self.driver.find_elements_by_css_selector('tbody tr:nth-child(1) td')]
         rv = dict(zip(headers, values))
         return rv
 
+    def _read_reports_page(self):
+        with metrics.span('extract'):
+            headers, rows = self.driver.execute_script(REPORT_ROWS_SCRIPT)
+        if headers:
+            headers[-1] = 'Comment'
+        # "no records" row has one cell
+        return [dict(zip(headers, row)) for row in rows if len(row) == len(headers)]
+
+    @timed()
+    def get_report_history(self, years, since=None):
+        """
+        [(year, document), ...] of years, all pages of year are read unless page has
+        only documents older than since date (YYYY-MM-DD)
+        """
+        rv = []
+        for year in years:
+            self._show_reports(year)
+            while True:
+                page = self._read_reports_page()
+                rv.extend((year, row) for row in page)
+                if not page or since and all(_report_date(row['Дата']) < since for row in page):
+                    break
+                next_page = self.driver.find_elements_by_css_selector(
+                    '.ui-paginator-next:not(.ui-state-disabled)')
+                if not next_page:
+                    break
+                next_page[0].click()
+                self.wait_callback(lambda: self._read_reports_page()[:1] != page[:1])
+        return rv
+
+    @timed()
     def _send_report_create_form(self, code, period=None, year=None):
         code = code.upper()
 
-        self.get('https://cabinet.sfs.gov.ua/reporting/doc/new')
+        self.get(config.cabinet_url + '/reporting/doc/new')
         self.wait_visible('div.ui-panel-content.ui-widget-content')
         panel = self.get_element('div.ui-panel-content.ui-widget-content')
 
@@ -464,6 +1374,7 @@ class Cabinet(SeleniumHelperMixin):
             self.get_element('button i.fa.fa-plus').click()
             self.wait_visible('button i.fa.fa-upload')
 
+    @timed()
     def _send_report_upload(self, filename):
         # def wait():
         #     self.wait_invisible('p-progressbar')
@@ -481,6 +1392,7 @@ class Cabinet(SeleniumHelperMixin):
         self.wait_invisible('p-progressbar')
         self.wait_visible('button i.fa.fa-key')
 
+    @timed()
     def _send_report_sign_and_send(self, code, key_path, password):
         def _get_last(wait_icon, click=False):
             # just checking that last is the one
@@ -506,20 +1418,22 @@ class Cabinet(SeleniumHelperMixin):
 
         _get_last('key', click=True)
 
+        self.send_clicked = True
         self.get_element('button i.fa.fa-send').click()
 
         _get_last('paper-plane', click=False)
 
-    def send_f0103306_report(self, filename, key_path, password=KEY_PASSWORD):
-        content = open(filename, 'rb').read()
+    @timed()
+    def send_f0103306_report(self, filename, key_path, password=None, header=None):
+        header = header or read_outbox_header(filename)
 
-        match = re.search(b'<PERIOD_YEAR>(\d+)</PERIOD_YEAR>', content, re.MULTILINE)
-        assert match, 'Could not find PERIOD_YEAR (skipping) %s' % filename
-        year = int(match.group(1))
+        assert (header['PERIOD_YEAR'] or '').isdigit(), \
+            'Could not find PERIOD_YEAR (skipping) %s' % filename
+        year = int(header['PERIOD_YEAR'])
 
-        match = re.search(b'<PERIOD_MONTH>(\d+)</PERIOD_MONTH>', content, re.MULTILINE)
-        assert match, 'Could not find PERIOD_MONTH (skipping) %s' % filename
-        period_month = int(match.group(1))
+        assert (header['PERIOD_MONTH'] or '').isdigit(), \
+            'Could not find PERIOD_MONTH (skipping) %s' % filename
+        period_month = int(header['PERIOD_MONTH'])
         assert period_month in (3, 6, 9, 12), 'Unknown PERIOD_MONTH: {}'.format(period_month)
         period = {
             3: 'I квартал',
@@ -531,7 +1445,7 @@ class Cabinet(SeleniumHelperMixin):
         self._send_report_upload(filename)
         self._send_report_sign_and_send('F0103306', key_path, password)
 
-    def send_f3000511_report(self, filename, key_path, password=KEY_PASSWORD):
+    def send_f3000511_report(self, filename, key_path, password=None):
         raise NotImplementedError('F30 Not implemeneted!!! (need refactoring for new cabinet)')
         # content = open(filename, 'rb').read()
         # subreports = re.findall(b'<FILENAME>([\w\d\.]+)</FILENAME>', content)
@@ -603,9 +1517,11 @@ class Cabinet(SeleniumHelperMixin):
 
 # FitSheetWrapper from https://stackoverflow.com/a/9137934/450103
 class SheetWrapper(object):
-    def __init__(self, sheet):
+    def __init__(self, sheet, deferred_autofit=False):
         self.sheet = sheet
         self.widths = dict()
+        # with deferred autofit widths are set once by fit_columns before save
+        self.autofit = arial10.ColumnAutofit() if deferred_autofit else None
 
     def write(self, r, c, label='', style=None):
         if isinstance(label, datetime) and not style:
@@ -616,11 +1532,20 @@ class SheetWrapper(object):
             self.sheet.write(r, c, label, style)
         else:
             self.sheet.write(r, c, label)
-        width = arial10.fitwidth(style and style.num_format_str or str(label))
+        text = style and style.num_format_str or str(label)
+        if self.autofit:
+            self.autofit.add(c, text)
+            return
+        width = arial10.metrics.fitwidth(text)
         if width > self.widths.get(c, 0):
             self.widths[c] = width
             self.sheet.col(c).width = int(width)
 
+    def fit_columns(self):
+        for c, width in self.autofit.widths().items():
+            self.widths[c] = width
+            self.sheet.col(c).width = int(width)
+
     def __getattr__(self, attr):
         return getattr(self.sheet, attr)
 
@@ -628,7 +1553,7 @@ class SheetWrapper(object):
 def open_xls(filename, headers=[]):
     if os.path.exists(filename):
         rb = xlrd.open_workbook(filename, formatting_info=True)
-        wb = xlutils.copy.copy(rb)
+        wb = xlutils_copy.copy(rb)
         ws = SheetWrapper(wb.get_sheet(0))
     else:
         wb = xlwt.Workbook()
@@ -638,13 +1563,213 @@ def open_xls(filename, headers=[]):
     return ws, wb
 
 
-def append_xls(filename, headers, *rows):
-    ws, wb = open_xls(filename, headers)
-    for row in rows:
-        y = len(ws.rows)
+def read_xls_rows(filename):
+    wb = xlrd.open_workbook(filename)
+    ws = wb.sheet_by_index(0)
+    headers = ws.row_values(0)
+    for i in range(1, ws.nrows):
+        yield OrderedDict(
+            (header, xlrd.xldate_as_datetime(cell.value, wb.datemode)
+             if cell.ctype == xlrd.XL_CELL_DATE else cell.value)
+            for header, cell in zip(headers, ws.row(i))
+        )
+
+
+def write_xls(filename, headers, rows):
+    """Returns False if rows do not fit xls sheet, file is not written then"""
+    rows = list(rows)
+    if len(headers) > XLS_MAX_COLUMNS or len(rows) >= XLS_MAX_ROWS:
+        log.warning('%s is not written: %s columns and %s rows do not fit xls sheet',
+                    filename, len(headers), len(rows))
+        return False
+    wb = xlwt.Workbook()
+    ws = SheetWrapper(wb.add_sheet('0'), deferred_autofit=True)
+    for x, header in enumerate(headers):
+        ws.write(0, x, header)
+    for y, row in enumerate(rows, 1):
         for x, cell in enumerate(row):
             ws.write(y, x, cell)
-    wb.save(filename)
+    ws.fit_columns()
+    wb.save(filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+    return True
+
+
+XLS_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.strftime(XLS_DATETIME_FORMAT)
+    raise TypeError('{!r} is not json serializable'.format(value))
+
+
+class Journal:
+    """
+    Append-only jsonl file of records, one line written and synced per record,
+    so results are not lost on crash and concurrent writers do not clobber each other.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self._repaired = False
+
+    def _repair(self):
+        # Dropping partial last line left by crash, so next record starts on it's own line
+        with open(self.filename, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b'\n'):
+                log.warning('Dropping partial record in %s', self.filename)
+                f.truncate(content.rfind(b'\n') + 1)
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=_json_default) + '\n'
+        with self.lock:
+            if not self._repaired and self.exists():
+                self._repair()
+            self._repaired = True
+            with open(self.filename, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def __iter__(self):
+        if not self.exists():
+            return
+        with open(self.filename, encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # partial record
+                yield json.loads(line, object_pairs_hook=OrderedDict)
+
+    def latest(self, key):
+        # last record by key, records are in order key was seen first
+        rv = OrderedDict()
+        for record in self:
+            rv[record[key]] = record
+        return rv
+
+    def export_xls(self, filename, headers, convert_row=None, unique_key=None):
+        records = self.latest(unique_key).values() if unique_key else self
+        rows = ([record.get(k, '') for k in headers] for record in records)
+        if convert_row:
+            rows = map(convert_row, rows)
+        if write_xls(filename, headers, rows):
+            log.info('Exported %s to %s', self.filename, filename)
+
+
+def parse_amount(value):
+    """Number of amount like '-1 234,56', None if empty or not a number"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = re.sub(r'\s', '', value or '').replace(',', '.')
+    try:
+        return float(text) if text else None
+    except ValueError:
+        log.debug('Not an amount: %r', value)
+        return None
+
+
+# sqlite, arrow
+COLUMN_TYPES = {
+    int: ('INTEGER', 'int64'),
+    float: ('REAL', 'float64'),
+    str: ('TEXT', 'string'),
+}
+
+
+def export_table(name, columns, rows, formats=None, results_dir=RESULTS_DIR):
+    """
+    Replaces table name of columns [(name, int|float|str), ...] in results.db,
+    <name>.csv and <name>.parquet (if pyarrow is installed) of results_dir
+    """
+    formats = config.export_formats if formats is None else formats
+    rows = list(rows)
+    names = [column for column, _ in columns]
+    os.makedirs(results_dir, exist_ok=True)
+    if 'sqlite' in formats:
+        db = sqlite3.connect(os.path.join(results_dir, os.path.basename(RESULTS_DB_FILENAME)))
+        try:
+            with db:
+                db.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+                db.execute('CREATE TABLE "{}" ({})'.format(name, ', '.join(
+                    '"{}" {}'.format(column, COLUMN_TYPES[type_][0]) for column, type_ in columns)))
+                db.executemany('INSERT INTO "{}" VALUES ({})'.format(
+                    name, ', '.join('?' * len(columns))), rows)
+        finally:
+            db.close()
+    if 'csv' in formats:
+        filename = os.path.join(results_dir, name + '.csv')
+        # utf-8 with BOM, so excel reads cyrillic
+        with open(filename + '.tmp', 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+            writer.writerows(rows)
+        os.replace(filename + '.tmp', filename)
+    if 'parquet' in formats and pyarrow:
+        filename = os.path.join(results_dir, name + '.parquet')
+        table = pyarrow.table(OrderedDict(
+            (column, pyarrow.array([row[i] for row in rows], type=COLUMN_TYPES[type_][1]))
+            for i, (column, type_) in enumerate(columns)))
+        pyarrow_parquet.write_table(table, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+    log.info('Exported %s rows of %s to %s', len(rows), name, results_dir)
+
+
+def _typed_value(label, value):
+    if label in BUDGET_STATUS_AMOUNT_FIELDS:
+        return parse_amount(value)
+    if isinstance(value, datetime):
+        return value.strftime(XLS_DATETIME_FORMAT)
+    if value is None or value == '':
+        return None
+    if label.startswith('Дата'):
+        return _report_date(str(value))
+    return str(value)
+
+
+SECTION_TABLES = {
+    'payer': 'payer_info',
+    'budget': 'budget_status',
+    'reports': 'report_status',
+}
+
+
+def export_report_tables(records, sections):
+    """
+    Table per report section of latest records, budget status blocks of columns are
+    rows of (inn, code) there, amounts are numbers and dates are YYYY-MM-DD
+    """
+    records = list(records)
+    base = [('inn', int), ('fio', str), ('parsed', str)]
+    for name, _, headers in sections:
+        if name == 'budget':
+            columns = base + [('code', str)] + [
+                (field, float if field in BUDGET_STATUS_AMOUNT_FIELDS else str)
+                for field in BUDGET_STATUS_FIELDS]
+            codes = OrderedDict((h.rpartition(' =')[2], None) for h in headers)
+            rows = []
+            for record in records:
+                for code in codes:
+                    values = [record.get(field + ' =' + code) for field in BUDGET_STATUS_FIELDS]
+                    if any(value not in (None, '') for value in values):
+                        row = [record['inn'], record.get('fio'),
+                               _typed_value('parsed', record.get('parsed')), code]
+                        row.extend(_typed_value(f, v) for f, v in zip(BUDGET_STATUS_FIELDS, values))
+                        rows.append(row)
+        else:
+            columns = base + [(header, str) for header in headers]
+            keys = ['parsed'] + headers
+            rows = []
+            for record in records:
+                row = [record['inn'], record.get('fio')]
+                row.extend(_typed_value(k, record.get(k)) for k in keys)
+                rows.append(row)
+        export_table(SECTION_TABLES[name], columns, rows)
 
 
 def write_row_by_index_xls(filename, index, row):
@@ -654,113 +1779,807 @@ def write_row_by_index_xls(filename, index, row):
     wb.save(filename)
 
 
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    path TEXT PRIMARY KEY,
+    inn INTEGER NOT NULL,
+    fio TEXT,
+    expires TEXT,
+    size INTEGER,
+    mtime REAL,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS keys_inn ON keys (inn);
+CREATE INDEX IF NOT EXISTS keys_fingerprint ON keys (fingerprint);
+-- bumped on every change of keys, so loaded keys are cached while it's the same
+CREATE TABLE IF NOT EXISTS keys_version (version INTEGER NOT NULL);
+INSERT INTO keys_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM keys_version);
+
+CREATE TABLE IF NOT EXISTS outbox_index (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    header TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sent_index (
+    path TEXT PRIMARY KEY,
+    tin INTEGER,
+    c_doc TEXT,
+    c_doc_sub TEXT,
+    c_doc_stan TEXT,
+    period_year INTEGER,
+    period_month INTEGER,
+    period_type INTEGER,
+    fingerprint TEXT,
+    mtime REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS sent_index_report
+    ON sent_index (tin, c_doc, c_doc_sub, period_year, period_month, period_type);
+CREATE INDEX IF NOT EXISTS sent_index_fingerprint ON sent_index (fingerprint);
+
+CREATE TABLE IF NOT EXISTS dir_mtimes (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS outbox_queue (
+    path TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_queue_state ON outbox_queue (state, next_attempt);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    report TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL
+);
+
+CREATE TABLE IF NOT EXISTS job_inns (
+    job_id INTEGER NOT NULL,
+    inn INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    duration REAL,
+    updated REAL,
+    PRIMARY KEY (job_id, inn)
+);
+CREATE INDEX IF NOT EXISTS job_inns_inn ON job_inns (inn, updated);
+
+CREATE TABLE IF NOT EXISTS inn_sections (
+    report TEXT NOT NULL,
+    inn INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    refreshed REAL NOT NULL,
+    PRIMARY KEY (report, inn, section)
+);
+
+CREATE TABLE IF NOT EXISTS report_history (
+    inn INTEGER NOT NULL,
+    c_doc TEXT NOT NULL,
+    reg_num TEXT NOT NULL,
+    d_reg TEXT NOT NULL,
+    year INTEGER,
+    c_sti_name TEXT,
+    period TEXT,
+    attachments TEXT,
+    status TEXT,
+    updated REAL,
+    PRIMARY KEY (inn, c_doc, reg_num, d_reg)
+);
+
+CREATE TABLE IF NOT EXISTS report_history_marks (
+    inn INTEGER PRIMARY KEY,
+    year INTEGER NOT NULL,
+    d_reg TEXT,
+    updated REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS browsers (
+    pid INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    owner INTEGER NOT NULL,
+    owner_started REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    inn INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    used REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS key_dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    files TEXT NOT NULL,
+    subdirs TEXT NOT NULL
+);
+"""
+
+_db_local = threading.local()
+
+
+def get_db(filename=DB_FILENAME):
+    # sqlite connections can't be shared between threads, so one per thread
+    conns = _db_local.__dict__.setdefault('conns', {})
+    if filename not in conns:
+        db = sqlite3.connect(filename, timeout=60)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(DB_SCHEMA)
+        conns[filename] = db
+    return conns[filename]
+
+
+class DbMixin:
+    """db is connection of current thread, so objects can be shared by workers"""
+    db_filename = DB_FILENAME
+
+    @property
+    def db(self):
+        return get_db(self.db_filename)
+
+
+def file_fingerprint(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+    return '{}:{}'.format(os.path.getsize(path), sha1.hexdigest())
+
+
+class KeyStore(DbMixin):
+    headers = ['inn', 'fio', 'filename', 'expires']
+
+    def __init__(self, filename=DB_FILENAME):
+        self.filename = self.db_filename = filename
+        if not self.db.execute('SELECT 1 FROM keys LIMIT 1').fetchone():
+            self._import()
+
+    def _import(self):
+        if os.path.exists(KEYS_JOURNAL_FILENAME):
+            rows = Journal(KEYS_JOURNAL_FILENAME)
+        elif os.path.exists(KEYS_FILENAME):
+            rows = read_xls_rows(KEYS_FILENAME)
+        else:
+            return
+        for row in rows:
+            self.add(int(row['inn']), row['fio'], row['filename'], row['expires'])
+        log.info('Keys imported to %s', self.filename)
+
+    def add(self, inn, fio, path, expires, fingerprint=None):
+        size = mtime = None
+        if os.path.exists(path):
+            size, mtime = os.path.getsize(path), os.path.getmtime(path)
+            fingerprint = fingerprint or file_fingerprint(path)
+        with self.db:
+            # replace moves row to the end, so last added key for inn wins on load
+            self.db.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (path, inn, fio, expires, size, mtime, fingerprint))
+            self.db.execute('UPDATE keys_version SET version = version + 1')
+
+    def remove(self, path):
+        with self.db:
+            self.db.execute('DELETE FROM keys WHERE path = ?', (path,))
+            self.db.execute('UPDATE keys_version SET version = version + 1')
+
+    def load(self):
+        return OrderedDict(
+            (row['inn'], row['path'])
+            for row in self.db.execute('SELECT inn, path FROM keys ORDER BY rowid')
+        )
+
+    def version(self):
+        return self.db.execute('SELECT version FROM keys_version').fetchone()[0]
+
+    def paths(self):
+        """path -> (size, mtime) of key file when it was checked"""
+        return dict((row[0], (row[1], row[2]))
+                    for row in self.db.execute('SELECT path, size, mtime FROM keys'))
+
+    def touch(self, path):
+        # content is the same, only stat is updated (row keeps it's order)
+        with self.db:
+            self.db.execute('UPDATE keys SET size = ?, mtime = ? WHERE path = ?',
+                            (os.path.getsize(path), os.path.getmtime(path), path))
+
+    def get_by_inn(self, inn):
+        return self.db.execute('SELECT * FROM keys WHERE inn = ? ORDER BY rowid DESC',
+                               (inn,)).fetchone()
+
+    def get_by_fingerprint(self, fingerprint):
+        return self.db.execute('SELECT * FROM keys WHERE fingerprint = ? ORDER BY rowid DESC',
+                               (fingerprint,)).fetchone()
+
+    def export_xls(self, filename=KEYS_FILENAME):
+        rows = self.db.execute('SELECT inn, fio, path, expires FROM keys ORDER BY rowid')
+        write_xls(filename, self.headers, (list(row) for row in rows))
+        log.info('Keys exported to %s', filename)
+
+
 class KeysMap(dict):
+    """inn -> key path, loads are cached while key store is unchanged"""
+    _cache = {}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.store = KeyStore()
         self.load()
 
-    def load(self, filename=KEYS_FILENAME):
-        if os.path.exists(filename):
-            wb = xlrd.open_workbook(filename, formatting_info=False)
-            ws = wb.sheet_by_index(0)
-            for i in range(1, ws.nrows):
-                row = ws.row(i)
-                inn = int(row[0].value)
-                path = row[2].value
-                self[inn] = path
-            # wb.close()
-
-        skipped = []
-        for inn, path in self.items():
-            if not os.path.exists(path):
-                log.warning('Skipping %s on key load: file not found %s', inn, path)
-                skipped.append(inn)
-
-        for inn in skipped:
-            self.pop(inn)
-
-        log.info('Keys loaded (%s) from %s', len(self), filename)
-
-    def add_key(self, inn, fio, filename, expires):
+    def load(self):
+        stamp = self.store.version()
+        cached = KeysMap._cache.get(self.store.filename)
+        if cached and cached[0] == stamp:
+            self.update(cached[1])
+            return
+        self.update(self.store.load())
+        KeysMap._cache[self.store.filename] = (stamp, dict(self))
+        log.info('Keys loaded (%s) from %s', len(self), self.store.filename)
+
+    def get_path(self, inn):
+        # existence is checked only for keys actually used
+        path = self.get(inn)
+        if path and not os.path.exists(path):
+            log.warning('Skipping %s: key file not found %s', inn, path)
+            return None
+        return path
+
+    def add_key(self, inn, fio, filename, expires, fingerprint=None):
         self[inn] = filename
-        append_xls(get_relative_path('keys.xls'), ['inn', 'fio', 'filename', 'expires'],
-                   [inn, fio, filename, expires])
-
+        self.store.add(inn, fio, filename, expires, fingerprint)
+
+    def save(self, filename=KEYS_FILENAME):
+        self.store.export_xls(filename)
+
+
+class BrowserSupervisor(DbMixin):
+    """
+    Process trees of started browsers (chromedriver with it's chrome), saved in browsers
+    table, so browsers left by killed run are killed by next one. Browser is recycled after
+    max_sessions cabinets or when it's processes use more than max_rss MB.
+    Processes are tracked with psutil, without it only sessions are counted.
+    """
+
+    def __init__(self, max_sessions=20, max_rss=1024, db_filename=DB_FILENAME):
+        self.max_sessions = max_sessions
+        self.max_rss = max_rss
+        self.db_filename = db_filename
+        self.sessions = {}  # chromedriver pid -> cabinets
+        self.workers = defaultdict(lambda: {'browsers': 0, 'sessions': 0, 'peak_rss': 0})
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def driver_pid(driver):
+        process = getattr(getattr(driver, 'service', None), 'process', None)
+        return process and process.pid
+
+    @staticmethod
+    def tree(pid):
+        """Process and all it's descendants, empty if it is not running"""
+        try:
+            process = psutil.Process(pid)
+            return [process] + process.children(recursive=True)
+        except psutil.Error:
+            return []
 
-def scan_keys(keys_dir=KEYS_DIR):
-    keys_map = KeysMap()
-    patterns = ['Key-6.dat', '*.jks', '*.zs2', '*.ZS2']
-    if glob2:
-        files = sum((list(glob2.iglob(os.path.join(KEYS_DIR, '**/%s' % pattern)))
-                    for pattern in patterns), [])
-    else:
-        files = sum((list(glob.iglob(os.path.join(KEYS_DIR, '**/%s' % pattern), recursive=True))
-                    for pattern in patterns), [])
+    @staticmethod
+    def is_running(pid, started):
+        try:
+            return abs(psutil.Process(pid).create_time() - started) < 1
+        except psutil.Error:
+            return False
 
-    log.info('Keys (%s) in %s', len(files), keys_dir)
-    for filename in files:
-        filename = os.path.abspath(filename)
-        if filename not in keys_map.values():
-            log.info('Checking new key %s', filename)
-            cabinet = Cabinet()
+    @staticmethod
+    def kill(processes):
+        for process in processes:
             try:
-                inn, fio, expires = cabinet.pre_login_cert(filename)
-            except Exception as e:
-                log.exception('Error occured on key processing %s %s', filename, repr(e))
-                if DEBUG:
-                    import pdb; pdb.set_trace()  # noqa
+                process.kill()
+            except psutil.Error:
+                pass
+        psutil.wait_procs(processes, timeout=WAIT_TIMEOUT)
+
+    def register(self, driver):
+        pid = self.driver_pid(driver)
+        with self.lock:
+            self.workers[threading.current_thread().name]['browsers'] += 1
+        if not psutil or not pid:
+            return
+        owner = psutil.Process()
+        rows = []
+        for process in self.tree(pid):
+            try:
+                rows.append((process.pid, process.create_time(), owner.pid, owner.create_time()))
+            except psutil.Error:
+                pass
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO browsers '
+                                '(pid, started, owner, owner_started) VALUES (?, ?, ?, ?)', rows)
+
+    def start_session(self, driver):
+        with self.lock:
+            pid = self.driver_pid(driver)
+            self.sessions[pid] = self.sessions.get(pid, 0) + 1
+            self.workers[threading.current_thread().name]['sessions'] += 1
+
+    def rss(self, driver):
+        """MB used by browser processes (0 without psutil), counted to peak of worker"""
+        total = 0
+        if psutil:
+            for process in self.tree(self.driver_pid(driver)):
+                try:
+                    total += process.memory_info().rss
+                except psutil.Error:
+                    pass
+        total /= 2 ** 20
+        with self.lock:
+            worker = self.workers[threading.current_thread().name]
+            worker['peak_rss'] = max(worker['peak_rss'], total)
+        return total
+
+    def should_recycle(self, driver):
+        pid = self.driver_pid(driver)
+        rss = self.rss(driver)
+        if self.sessions.get(pid, 0) >= self.max_sessions:
+            log.info('Recycling browser %s after %s sessions', pid, self.sessions[pid])
+            return True
+        if rss > self.max_rss:
+            log.info('Recycling browser %s using %.0f MB', pid, rss)
+            return True
+        return False
+
+    def quit(self, driver):
+        """Quits driver and kills it's processes left running"""
+        pid = self.driver_pid(driver)
+        processes = self.tree(pid) if psutil and pid else []
+        if processes:
+            self.rss(driver)
+        try:
+            driver.quit()
+        except WebDriverException as e:
+            log.warning('Browser %s quit failed: %s', pid, repr(e))
+        with self.lock:
+            self.sessions.pop(pid, None)
+        if processes:
+            self.kill(processes)
+            with self.db:
+                self.db.executemany('DELETE FROM browsers WHERE pid = ?',
+                                    [(process.pid,) for process in processes])
+
+    def kill_orphans(self):
+        """Kills browsers of runs which are not running anymore and removes their profiles"""
+        if not psutil:
+            log.debug('Orphan browsers are not looked for without psutil (pip install psutil)')
+            return
+        orphans = {}
+        owned = set()
+        for pid, started, owner, owner_started in self.db.execute(
+                'SELECT pid, started, owner, owner_started FROM browsers').fetchall():
+            if self.is_running(owner, owner_started):
+                owned.update(process.pid for process in self.tree(pid))
                 continue
-            finally:
-                cabinet.quit()
-
-            log.info('Adding key inn=%s fio=%s expires=%s filename=%s',
-                     inn, fio, expires, filename)
-            keys_map.add_key(inn, fio, filename, expires)
+            if self.is_running(pid, started):
+                orphans.update((process.pid, process) for process in self.tree(pid))
+            with self.db:
+                self.db.execute('DELETE FROM browsers WHERE pid = ?', (pid,))
+
+        # browsers started before their pids were saved are found by profile
+        profile_prefix = os.path.join(tempfile.gettempdir(), PROFILE_PREFIX)
+        used_profiles = set()
+        for process in psutil.process_iter(['cmdline', 'create_time']):
+            profiles = [arg.split('=', 1)[1] for arg in process.info['cmdline'] or []
+                        if arg.startswith('--user-data-dir=' + profile_prefix)]
+            if not profiles or process.pid in orphans:
+                continue
+            if process.pid in owned or time() - process.info['create_time'] < ORPHAN_MIN_AGE:
+                used_profiles.update(profiles)
+            else:
+                orphans[process.pid] = process
+        if orphans:
+            log.warning('Killing %s processes of orphan browsers', len(orphans))
+            self.kill(list(orphans.values()))
+
+        used_dirs = set(os.path.dirname(profile) for profile in used_profiles)
+        for path in glob.glob(profile_prefix + '*'):
+            if path not in used_dirs and time() - os.path.getmtime(path) > ORPHAN_MIN_AGE:
+                log.info('Removing orphan browser profile %s', path)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def report(self):
+        for name, worker in sorted(self.workers.items()):
+            log.info('Browsers of %s: started %s, sessions %s, peak memory %.0f MB', name,
+                     worker['browsers'], worker['sessions'], worker['peak_rss'])
+
+
+supervisor = LazyObject(
+    lambda: BrowserSupervisor(config.browser_sessions, config.browser_rss))
+
+
+class SessionStore(DbMixin):
+    """Cabinet sessions (fio, cookies, storage) by inn, encrypted with key of key_filename"""
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, key_filename, db_filename=DB_FILENAME, ttl=SESSION_TTL):
+        self.db_filename = db_filename
+        self.ttl = ttl
+        if not os.path.exists(key_filename):
+            # readable by owner only, created once
+            os.makedirs(os.path.dirname(key_filename), mode=0o700, exist_ok=True)
+            fd = os.open(key_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cryptography_fernet.Fernet.generate_key())
+        with open(key_filename, 'rb') as f:
+            self.fernet = cryptography_fernet.Fernet(f.read().strip())
+
+    @classmethod
+    def get(cls):
+        """Shared store, None if cryptography is not installed"""
+        if not cryptography_fernet:
+            if cls._instance is None:
+                log.info('Sessions are not saved (pip install cryptography to reuse them)')
+                cls._instance = False
+            return None
+        with cls._lock:
+            if not cls._instance:
+                cls._instance = cls(config.session_key)
+        return cls._instance
+
+    def save(self, inn, fio, cookies, storage):
+        data = json.dumps({'fio': fio, 'cookies': cookies, 'storage': storage}).encode()
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                            (inn, self.fernet.encrypt(data), time()))
+
+    def load(self, inn):
+        row = self.db.execute('SELECT data, used FROM sessions WHERE inn = ?', (inn,)).fetchone()
+        if not row:
+            return None
+        if time() - row['used'] > self.ttl:
+            self.remove(inn)
+            return None
+        try:
+            return json.loads(self.fernet.decrypt(row['data']).decode())
+        except cryptography_fernet.InvalidToken:
+            log.warning('Saved session of %s could not be decrypted', inn)
+            self.remove(inn)
+            return None
+
+    def touch(self, inn):
+        with self.db:
+            self.db.execute('UPDATE sessions SET used = ? WHERE inn = ?', (time(), inn))
+
+    def remove(self, inn):
+        with self.db:
+            self.db.execute('DELETE FROM sessions WHERE inn = ?', (inn,))
+
+
+def walk_keys(keys_dir=KEYS_DIR, db_filename=DB_FILENAME):
+    """
+    Key files under keys_dir in one walk. Directory listings are kept in key_dirs
+    and reused while directory mtime is unchanged, so only changed directories are listed.
+    """
+    db = get_db(db_filename)
+    index = dict((row['path'], row) for row in db.execute('SELECT * FROM key_dirs')
+                 if row['path'] == keys_dir or row['path'].startswith(keys_dir + os.sep))
+    rv, updated, visited, stack = [], [], set(), [keys_dir]
+    while stack:
+        path = stack.pop()
+        try:
+            realpath, mtime = os.path.realpath(path), os.stat(path).st_mtime
+        except OSError:
+            continue
+        if realpath in visited:
+            continue  # symlink loop
+        visited.add(realpath)
 
+        row = index.pop(path, None)
+        if row and row['mtime'] == mtime:
+            files, subdirs = json.loads(row['files']), json.loads(row['subdirs'])
+        else:
+            files, subdirs = [], []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif any(fnmatch.fnmatchcase(entry.name.lower(), pattern)
+                             for pattern in KEY_PATTERNS):
+                        files.append(entry.name)
+            updated.append((path, mtime, json.dumps(files), json.dumps(subdirs)))
+        rv.extend(os.path.join(path, name) for name in files)
+        stack.extend(os.path.join(path, name) for name in subdirs)
+
+    with db:
+        db.executemany('INSERT OR REPLACE INTO key_dirs VALUES (?, ?, ?, ?)', updated)
+        db.executemany('DELETE FROM key_dirs WHERE path = ?', ((path,) for path in index))
+    log.debug('Key dirs listed %s of %s', len(updated), len(visited))
+    return sorted(rv)
 
-def _get_report(filename, headers, method_name, method_kwargs={}):
-    log.info('Populating report %s', filename)
 
+def scan_keys(keys_dir=KEYS_DIR):
+    """Adds new keys to keys map, returns files of keys failed to check"""
     keys_map = KeysMap()
-    processed = []
+    files = walk_keys(os.path.abspath(keys_dir))
+    log.info('Keys (%s) in %s', len(files), keys_dir)
+    failed = []
+    try:
+        _scan_new_keys(keys_map, files, failed)
+    finally:
+        keys_map.save()
+    return failed
 
-    if os.path.exists(filename):
-        wb = xlrd.open_workbook(filename)
-        ws = wb.sheet_by_index(0)
-        for i in range(1, ws.nrows):
-            inn = ws.row(i)[0].value
-            if inn:
-                processed.append(int(inn))
 
-    to_process = set(keys_map) - set(processed)
-    log.info('Processing %s (processed already %s)', len(to_process), len(set(processed)))
+def _scan_new_keys(keys_map, files, failed):
+    known = keys_map.store.paths()
+    for filename in files:
+        filename = os.path.abspath(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        if known.get(filename) == (stat.st_size, stat.st_mtime):
+            continue
+
+        # keys are identified by content, so moved or renamed key is not checked again
+        fingerprint = file_fingerprint(filename)
+        row = keys_map.store.get_by_fingerprint(fingerprint)
+        if row and row['path'] == filename:
+            keys_map.store.touch(filename)
+            continue
+        if row:
+            log.info('Key moved inn=%s %s -> %s', row['inn'], row['path'], filename)
+            keys_map.add_key(row['inn'], row['fio'], filename, row['expires'], fingerprint)
+            if not os.path.exists(row['path']):
+                keys_map.store.remove(row['path'])
+            continue
+        if filename in known:
+            # replaced in place, like renewed key saved under the same name
+            log.info('Key file changed %s', filename)
+
+        owner = read_offline_cert(filename)
+        if owner:
+            inn, fio, expires = owner
+            log.info('Adding key from certificate inn=%s fio=%s expires=%s filename=%s',
+                     inn, fio, expires, filename)
+            keys_map.add_key(inn, fio, filename, expires, fingerprint)
+            continue
 
-    for inn in to_process:
+        log.info('Checking new key %s', filename)
         cabinet = Cabinet()
         try:
-            cabinet.login(keys_map[inn])
-            assert cabinet.inn == inn, 'Key inn in store and after login not matched!'
-            data = getattr(cabinet, method_name)(**method_kwargs)
+            inn, fio, expires = cabinet.pre_login_cert(filename)
         except Exception as e:
-            log.exception('Error occured on %s processing %s %s', method_name, inn, repr(e))
-            if DEBUG:
+            log.exception('Error occured on key processing %s %s', filename, repr(e))
+            if config.debug:
                 import pdb; pdb.set_trace()  # noqa
+            failed.append(filename)
             continue
         finally:
             cabinet.quit()
-        log.info('Adding row inn=%s fio=%s data=%s',
-                 cabinet.inn, cabinet.fio, data)
-        skipped_headers = [h for h in headers if h not in data]
-        if skipped_headers:
-            log.warning('Skipped headers: %s',  skipped_headers)
-        row = [data.get(k, '') for k in headers]
-        append_xls(filename,
-                   ['inn', 'fio', 'parsed'] + headers,
-                   [cabinet.inn, cabinet.fio, datetime.now()] + row)
+
+        log.info('Adding key inn=%s fio=%s expires=%s filename=%s',
+                 inn, fio, expires, filename)
+        keys_map.add_key(inn, fio, filename, expires, fingerprint)
+
+
+class ReportJob(DbMixin):
+    """Per-inn state of report run: pending, running, done or failed, with attempts and errors"""
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+    def __init__(self, report, resume=False, db_filename=DB_FILENAME):
+        self.report = report
+        self.db_filename = db_filename
+        row = resume and self.db.execute(
+            'SELECT id FROM jobs WHERE report = ? ORDER BY id DESC LIMIT 1', (report,)).fetchone()
+        if row:
+            self.id = row[0]
+            log.info('Resuming job %s of %s', self.id, report)
+        else:
+            if resume:
+                log.warning('No job to resume for %s, starting new one', report)
+            with self.db:
+                self.id = self.db.execute('INSERT INTO jobs (report, started) VALUES (?, ?)',
+                                          (report, time())).lastrowid
+
+    def exists(self):
+        return bool(self.db.execute(
+            'SELECT 1 FROM jobs JOIN job_inns ON id = job_id WHERE report = ? LIMIT 1',
+            (self.report,)).fetchone())
+
+    def statuses(self, this_job=False):
+        """inn -> last status over all jobs of report (or this job only)"""
+        return dict((row[0], row[1]) for row in self.db.execute(
+            'SELECT inn, status FROM job_inns JOIN jobs ON id = job_id '
+            'WHERE report = ? AND (? OR id = ?) ORDER BY updated',
+            (self.report, not this_job, self.id)))
+
+    def _set(self, inn, status, **fields):
+        fields = dict(fields, status=status, updated=time())
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO job_inns (job_id, inn, status) VALUES (?, ?, ?)',
+                            (self.id, inn, status))
+            self.db.execute('UPDATE job_inns SET {}, attempts = attempts + ? '
+                            'WHERE job_id = ? AND inn = ?'.format(
+                                ', '.join('{} = ?'.format(k) for k in fields)),
+                            tuple(fields.values()) + (int(status == self.RUNNING), self.id, inn))
+
+    def add(self, inns, status=PENDING):
+        known = self.statuses(this_job=True)
+        with self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO job_inns (job_id, inn, status, updated) '
+                'VALUES (?, ?, ?, ?)',
+                [(self.id, inn, status, time()) for inn in inns if inn not in known])
+
+    def start(self, inn):
+        self._set(inn, self.RUNNING)
+
+    def finish(self, inn, error=None, duration=None):
+        self._set(inn, self.FAILED if error else self.DONE, last_error=error, duration=duration)
+
+    def counts(self):
+        return dict(self.db.execute('SELECT status, count(*) FROM job_inns WHERE job_id = ? '
+                                    'GROUP BY status', (self.id,)))
+
+    def refreshed(self):
+        """inn -> {section: time it was read last}, over all jobs of report"""
+        rv = defaultdict(dict)
+        for inn, section, refreshed in self.db.execute(
+                'SELECT inn, section, refreshed FROM inn_sections WHERE report = ?', (self.report,)):
+            rv[inn][section] = refreshed
+        return rv
+
+    def set_refreshed(self, inn, sections, refreshed=None, replace=True):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR {} INTO inn_sections (report, inn, section, refreshed) '
+                'VALUES (?, ?, ?, ?)'.format('REPLACE' if replace else 'IGNORE'),
+                [(self.report, inn, section, refreshed or time()) for section in sections])
+
+    def close(self):
+        counts = self.counts()
+        if not counts.get(self.PENDING) and not counts.get(self.RUNNING):
+            with self.db:
+                self.db.execute('UPDATE jobs SET finished = ? WHERE id = ?', (time(), self.id))
+        log.info('Job %s of %s: %s', self.id, self.report, counts)
+
+
+def _record_time(record):
+    parsed = record.get('parsed')
+    if isinstance(parsed, datetime):
+        return parsed.timestamp()
+    try:
+        return datetime.strptime(parsed, XLS_DATETIME_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+
+def _get_report(filename, sections):
+    """
+    Reads stale sections [(section, ttl days, headers), ...] of inns and merges them
+    with saved fields of fresh sections. Returns inns count by status of the job
+    """
+    log.info('Populating report %s', filename)
+
+    keys_map = KeysMap()
+    headers = ['inn', 'fio', 'parsed'] + [h for _, _, section_headers in sections
+                                          for h in section_headers]
+    journal = Journal(os.path.splitext(filename)[0] + '.jsonl')
+
+    if not journal.exists() and os.path.exists(filename):
+        # report created before journal
+        for row in read_xls_rows(filename):
+            if row['inn']:
+                row['inn'] = int(row['inn'])
+                journal.append(row)
+    records = journal.latest('inn')
+
+    job = ReportJob(os.path.basename(filename), resume=config.resume)
+    if not job.exists():
+        # first job of report created before job store
+        job.add(records, ReportJob.DONE)
+    refreshed = job.refreshed()
+    for inn, record in records.items():
+        if inn not in refreshed:
+            # rows of report created before sections were tracked are as fresh as they were parsed
+            refreshed[inn] = dict.fromkeys((name for name, _, _ in sections), _record_time(record))
+            job.set_refreshed(inn, refreshed[inn], _record_time(record), replace=False)
+
+    now = time()
+
+    def stale_sections(inn):
+        return [section for section in sections
+                if now - refreshed[inn].get(section[0], 0) >= section[1] * 24 * 3600]
+
+    # resumed job goes on with it's own inns, new one skips inns failed in any job of report
+    statuses = job.statuses(this_job=config.resume)
+    if config.only:
+        to_process = dict((int(inn), sections) for inn in config.only.split(','))
+    else:
+        skip = [] if config.retry_failed else [ReportJob.FAILED]
+        if config.resume:
+            skip.append(ReportJob.DONE)
+        to_process = dict((inn, stale_sections(inn)) for inn in keys_map
+                          if statuses.get(inn) not in skip and stale_sections(inn))
+    stale_counts = OrderedDict((name, 0) for name, _, _ in sections)
+    for stale in to_process.values():
+        for name, _, _ in stale:
+            stale_counts[name] += 1
+    log.info('Processing %s, stale sections %s (failed %s%s)', len(to_process),
+             dict(stale_counts), list(statuses.values()).count(ReportJob.FAILED),
+             ', retrying' if config.retry_failed else ', use --retry-failed to retry')
+    job.add(to_process)
+
+    def convert_row(row):
+        if isinstance(row[2], str) and row[2]:
+            row[2] = datetime.strptime(row[2], XLS_DATETIME_FORMAT)
+        return row
+
+    def process(inn):
+        job.start(inn)
+        started = time()
+        with metrics.span('inn', inn) as span:
+            span.error = _process_report_inn(journal, keys_map, inn, to_process[inn],
+                                             records.get(inn))
+        job.finish(inn, span.error, time() - started)
+        if not span.error:
+            job.set_refreshed(inn, [name for name, _, _ in to_process[inn]], started)
+        return span.error
+
+    try:
+        scheduler.map(process, sorted(to_process), failed=bool)
+    finally:
+        job.close()
+        export_report_tables(journal.latest('inn').values(), sections)
+        if 'xls' in config.export_formats:
+            journal.export_xls(filename, headers, convert_row, unique_key='inn')
+    return job.counts()
+
+
+def _process_report_inn(journal, keys_map, inn, sections, previous=None):
+    """Adds report row of inn with sections read again to journal, returns error or None"""
+    key_path = keys_map.get_path(inn)
+    if not key_path:
+        return 'key not found'
+    # fields of sections read again are replaced, other are kept from previous record
+    replaced = set(h for _, _, section_headers in sections for h in section_headers)
+    record = OrderedDict((k, v) for k, v in (previous or {}).items() if k not in replaced)
+    names = [name for name, _, _ in sections]
+    cabinet = Cabinet()
+    try:
+        cabinet.login(key_path, inn=inn)
+        assert cabinet.inn == inn, 'Key inn in store and after login not matched!'
+        data = OrderedDict()
+        for name in names:
+            data.update(cabinet.get_section(name, dict(record, **data)))
+    except Exception as e:
+        log.exception('Error occured on %s processing %s %s', names, inn, repr(e))
+        if config.debug:
+            import pdb; pdb.set_trace()  # noqa
+        return repr(e)
+    finally:
+        cabinet.quit()
+    log.info('Adding row inn=%s fio=%s sections=%s data=%s',
+             cabinet.inn, cabinet.fio, names, data)
+    skipped_headers = [h for _, _, section_headers in sections for h in section_headers
+                       if h not in data]
+    if skipped_headers:
+        log.warning('Skipped headers: %s',  skipped_headers)
+    record.update([('inn', cabinet.inn), ('fio', cabinet.fio), ('parsed', datetime.now())])
+    record.update(data)
+    journal.append(record)
 
 
 def get_info(filename=INFO_FILENAME):
-    headers = [
+    payer_headers = [
         'Прізвище, ім’я та по батькові',
         'Податковий номер',
         'Особливий режим',
@@ -791,98 +2610,715 @@ def get_info(filename=INFO_FILENAME):
         'Дата зняття з обліку =Товари',
         'Дата внесення змін =Товари',
     ]
+    budget_headers = []
     for k in OrderedDict((k, None) for k in BUDGET_STATUS_CODES.values()).keys():
-        headers.extend([
-            'ОДФС =' + k,
-            'Назва податку =' + k,
-            'Платіж =' + k,
-            'Код ЄДРПОУ отримувача =' + k,
-            'МФО =' + k,
-            'Назва отримувача =' + k,
-            'Бюджетний рахунок =' + k,
-            'Нараховано/зменшено =' + k,
-            'Сплачено до бюджету =' + k,
-            'Повернуто з бюджету =' + k,
-            'Пеня =' + k,
-            'Недоїмка =' + k,
-            'Переплата =' + k,
-            'Залишок несплаченої пені =' + k,
-            'saldo =' + k,
-        ])
-
-    _get_report(filename, headers, 'get_info')
+        budget_headers.extend(field + ' =' + k for field in BUDGET_STATUS_FIELDS)
+
+    return _get_report(filename, [('payer', config.payer_ttl, payer_headers),
+                                  ('budget', config.budget_ttl, budget_headers)])
+
+
+def warm_profile(profile_dir=PROFILE_DIR, visits=3):
+    # Several visits, because chrome writes code cache only for scripts executed repeatedly
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    cabinet = Cabinet(profile_dir=profile_dir)
+    try:
+        for _ in range(visits):
+            cabinet.get(config.cabinet_url + '/login')
+            cabinet.wait_invisible('.ui-blockui-document')
+            cabinet.wait_presence('#PKeyFileInput')
+    finally:
+        cabinet.quit()
+    wipe_profile_private(profile_dir)
+    log.info('Profile warmed %s', profile_dir)
 
 
 def get_report_status(filename=REPORT_STATUS_FILENAME):
     headers = ['ДФС', 'Форма', 'Номер', 'Дата', 'Період', 'Додатки', 'Comment']
-    _get_report(filename, headers, 'get_last_report_status')
+    return _get_report(filename, [('reports', config.reports_ttl, headers)])
 
 
-def send_outbox(outbox_dir=OUTBOX_DIR, sent_dir=SENT_DIR):
+def _report_date(text):
+    """YYYY-MM-DD of document date dd.mm.yyyy, so dates are ordered as text"""
+    try:
+        return datetime.strptime(text[:10], '%d.%m.%Y').strftime('%Y-%m-%d')
+    except ValueError:
+        return text
+
+
+class ReportHistory(DbMixin):
+    """
+    Documents of inns read from vreporting, with high-water mark per inn:
+    last year read and date of newest document seen
+    """
+    FIELDS = OrderedDict((
+        ('ДФС', 'c_sti_name'),
+        ('Форма', 'c_doc'),
+        ('Номер', 'reg_num'),
+        ('Дата', 'd_reg'),
+        ('Період', 'period'),
+        ('Додатки', 'attachments'),
+        ('Comment', 'status'),
+    ))
+
+    def __init__(self, db_filename=DB_FILENAME):
+        self.db_filename = db_filename
+
+    def mark(self, inn):
+        """(year, date) read up to or None"""
+        row = self.db.execute('SELECT year, d_reg FROM report_history_marks WHERE inn = ?',
+                              (inn,)).fetchone()
+        return row and tuple(row)
+
+    def add(self, inn, documents, year):
+        """Saves [(year, document), ...] read up to year, returns number of new documents"""
+        count = 'SELECT count(*) FROM report_history WHERE inn = ?'
+        before = self.db.execute(count, (inn,)).fetchone()[0]
+        rows = []
+        for doc_year, document in documents:
+            values = dict((column, document.get(label, '')) for label, column in self.FIELDS.items())
+            values['d_reg'] = _report_date(values['d_reg'])
+            rows.append(dict(values, inn=inn, year=doc_year, updated=time()))
+        mark = self.mark(inn)
+        newest = max([row['d_reg'] for row in rows] + [mark and mark[1] or ''])
+        columns = ('inn', 'year', 'updated') + tuple(self.FIELDS.values())
+        with self.db:
+            # documents of last year are read again, so their status is updated
+            self.db.executemany(
+                'INSERT OR REPLACE INTO report_history ({}) VALUES ({})'.format(
+                    ', '.join(columns), ', '.join('?' * len(columns))),
+                [tuple(row[column] for column in columns) for row in rows])
+            self.db.execute('INSERT OR REPLACE INTO report_history_marks '
+                            '(inn, year, d_reg, updated) VALUES (?, ?, ?, ?)',
+                            (inn, year, newest or None, time()))
+        return self.db.execute(count, (inn,)).fetchone()[0] - before
+
+    def export(self, filename):
+        rows = self.db.execute('SELECT inn, year, {} FROM report_history '
+                               'ORDER BY inn, d_reg DESC'.format(', '.join(self.FIELDS.values())))
+        rows = [tuple(row) for row in rows]
+        columns = [('inn', int), ('year', int)]
+        columns.extend((column, str) for column in self.FIELDS.values())
+        export_table('report_history', columns, rows)
+        if 'xls' in config.export_formats and write_xls(filename, ['inn', 'Рік'] + list(self.FIELDS),
+                                                 rows):
+            log.info('Report history exported to %s', filename)
+
+
+def _read_report_history(history, keys_map, inn, years, since=None):
+    """Saves documents of inn from years, returns error or None"""
+    key_path = keys_map.get_path(inn)
+    if not key_path:
+        return 'key not found'
+    cabinet = Cabinet()
+    try:
+        cabinet.login(key_path, inn=inn)
+        assert cabinet.inn == inn, 'Key inn in store and after login not matched!'
+        documents = cabinet.get_report_history(years, since)
+    except Exception as e:
+        log.exception('Error occured on report history %s %s', inn, repr(e))
+        if config.debug:
+            import pdb; pdb.set_trace()  # noqa
+        return repr(e)
+    finally:
+        cabinet.quit()
+    new = history.add(inn, documents, years[0])
+    log.info('Report history inn=%s fio=%s years %s-%s: read %s, new %s',
+             cabinet.inn, cabinet.fio, years[-1], years[0], len(documents), new)
+
+
+def get_report_history(filename=REPORT_HISTORY_FILENAME):
+    """
+    Reads documents of all years since --history-from on first run,
+    later runs read only documents newer than the ones seen. Returns {inn: error} of failed
+    """
     keys_map = KeysMap()
-    files = tuple(glob.iglob(os.path.join(OUTBOX_DIR, '*.xml')))
-    log.info('Outbox (%s) in %s', len(files), outbox_dir)
+    history = ReportHistory()
+    inns = [int(inn) for inn in config.only.split(',')] if config.only else sorted(keys_map)
+    this_year = datetime.now().year
+    log.info('Report history of %s inns', len(inns))
+
+    def process(inn):
+        year, since = history.mark(inn) or (config.history_from, None)
+        with metrics.span('inn', inn) as span:
+            span.error = _read_report_history(history, keys_map, inn,
+                                              list(range(this_year, year - 1, -1)), since)
+        return span.error
 
-    for filename in files:
-        filename = os.path.abspath(filename)
-        if not os.path.exists(filename):
-            continue  # this was subreport and was processed already
-        content = open(filename, 'rb').read()
+    try:
+        errors = scheduler.map(process, inns, failed=bool)
+    finally:
+        history.export(filename)
+    return OrderedDict((inn, error) for inn, error in zip(inns, errors) if error)
+
+
+def read_outbox_header(filename):
+    """DECLARHEAD fields, file is read by chunks only until DECLARHEAD is closed"""
+    header = dict.fromkeys(OUTBOX_HEADER_FIELDS)
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    depth = 0  # DECLAR=1, DECLARHEAD=2, it's fields=3 (LINKED_DOCS content is deeper)
+    with open(filename, 'rb') as f:
+        try:
+            for chunk in iter(lambda: f.read(OUTBOX_HEADER_CHUNK_SIZE), b''):
+                parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        depth += 1
+                        continue
+                    depth -= 1
+                    if element.tag == 'DECLARHEAD':
+                        return header
+                    if depth == 2 and element.tag in header and element.text:
+                        header[element.tag] = element.text.strip()
+        except ET.ParseError as e:
+            log.warning('Could not parse header of %s: %s', filename, e)
+    return header
 
-        match = re.search(b'<TIN>(\d+)</TIN>', content, re.MULTILINE)
-        if not match:
+
+class OutboxIndex(DbMixin):
+    """Parsed outbox headers by path, reused while file mtime and size are unchanged"""
+
+    def __init__(self, db_filename=DB_FILENAME):
+        self.db_filename = db_filename
+
+    def headers(self, files, chunk_size=500):
+        stats = OrderedDict()
+        for filename in files:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            stats[os.path.abspath(filename)] = (stat.st_mtime, stat.st_size)
+
+        rv, paths = OrderedDict(), list(stats)
+        for i in range(0, len(paths), chunk_size):
+            chunk = paths[i:i + chunk_size]
+            for row in self.db.execute(
+                    'SELECT * FROM outbox_index WHERE path IN ({})'.format(
+                        ','.join('?' * len(chunk))), chunk):
+                if stats[row['path']] == (row['mtime'], row['size']):
+                    rv[row['path']] = json.loads(row['header'])
+
+        updated = []
+        for path, (mtime, size) in stats.items():
+            if path not in rv:
+                rv[path] = read_outbox_header(path)
+                updated.append((path, mtime, size, json.dumps(rv[path])))
+        if updated:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO outbox_index VALUES (?, ?, ?, ?)',
+                                    updated)
+        log.debug('Outbox headers %s, parsed %s', len(rv), len(updated))
+        return OrderedDict((path, rv[path]) for path in stats)
+
+
+def _outbox_order(item):
+    filename, header = item
+    return (header['C_DOC'], header['C_DOC_SUB'] or '',
+            int(header['PERIOD_YEAR'] or 0), int(header['PERIOD_MONTH'] or 0), filename)
+
+
+def plan_outbox(files, keys_map):
+    """inn -> [(filename, header), ...] ordered by form and period, subreports are skipped"""
+    rv = OrderedDict()
+    for filename, header in OutboxIndex().headers(files).items():
+        if not header['TIN'] or not header['TIN'].isdigit():
             log.error('Could not find inn (skipping) %s', filename)
             continue
 
-        inn = int(match.group(1))
-        if inn not in keys_map:
+        inn = int(header['TIN'])
+        if not keys_map.get_path(inn):
             log.error('inn %s not found in keys map (skipping) %s', inn, filename)
             continue
 
-        match = re.search(b'<C_DOC>([\w\d]+)</C_DOC>', content, re.MULTILINE)
-        if not match:
+        if not header['C_DOC']:
             log.error('%s: report type not found (skipping) %s', inn, filename)
             continue
-        report_type = match.group(1).decode().upper()
-        assert report_type in ['F30', 'F01'], report_type
+        header['C_DOC'] = header['C_DOC'].upper()
+        if header['C_DOC'] not in ['F30', 'F01']:
+            log.error('%s: unknown report type %s (skipping) %s', inn, header['C_DOC'], filename)
+            continue
 
-        if report_type == 'F30':
-            match = re.search(b'<C_DOC_SUB>(\d+)</C_DOC_SUB>', content, re.MULTILINE)
-            if int(match.group(1)) != 5:
-                continue  # this is subreport, so processing only head report
+        if header['C_DOC'] == 'F30' and int(header['C_DOC_SUB'] or 0) != 5:
+            continue  # this is subreport, so processing only head report
 
-        cabinet = Cabinet()
-        try:
-            cabinet.login(keys_map[inn])
-            assert cabinet.inn == inn, 'Key inn in store and after login not matched!'
-            if report_type == 'F01':
-                subreports = cabinet.send_f0103306_report(filename, key_path=keys_map[inn])
-            elif report_type == 'F30':
-                subreports = cabinet.send_f3000511_report(filename, key_path=keys_map[inn])
+        rv.setdefault(inn, []).append((filename, header))
+
+    for items in rv.values():
+        items.sort(key=_outbox_order)
+    return OrderedDict(sorted(rv.items()))
+
+
+class OutboxQueue(DbMixin):
+    """
+    Durable outbox state: pending -> in-flight -> sent, or failed after OUTBOX_MAX_ATTEMPTS.
+    Failed attempts are retried with exponential backoff.
+    """
+    PENDING, IN_FLIGHT, SENT, FAILED = 'pending', 'in-flight', 'sent', 'failed'
+
+    def __init__(self, db_filename=DB_FILENAME):
+        self.db_filename = db_filename
+
+    def enqueue(self, files):
+        """Adds new head reports, returns files skipped as not settled yet"""
+        unsettled = []
+        known = dict((row['path'], row) for row in
+                     self.db.execute('SELECT path, state, fingerprint FROM outbox_queue'))
+        new = []
+        for filename in files:
+            filename = os.path.abspath(filename)
+            row = known.get(filename)
+            if row and row['state'] != self.SENT:
+                continue
+            try:
+                if time() - os.path.getmtime(filename) < OUTBOX_SETTLE_TIME:
+                    unsettled.append(filename)
+                    continue
+            except OSError:
+                continue  # moved meanwhile
+            new.append(filename)
+
+        for filename, header in OutboxIndex().headers(new).items():
+            if (header['C_DOC'] or '').upper() == 'F30' and int(header['C_DOC_SUB'] or 0) != 5:
+                continue  # subreport is sent with head report
+            row = known.get(filename)
+            try:
+                if row and row['fingerprint'] == file_fingerprint(filename):
+                    continue  # sent already, but not moved from outbox
+            except OSError:
+                continue
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO outbox_queue (path, state, updated) '
+                                'VALUES (?, ?, ?)', (filename, self.PENDING, time()))
+            log.info('Queued %s', os.path.basename(filename))
+        return unsettled
+
+    def recover(self, sent_dir=SENT_DIR):
+        # Reports left in-flight by crash may be sent already, so they are never retried blindly
+        for row in self.db.execute('SELECT path FROM outbox_queue WHERE state = ?',
+                                   (self.IN_FLIGHT,)).fetchall():
+            sent_path = os.path.join(sent_dir, os.path.basename(row['path']))
+            if not os.path.exists(row['path']) and os.path.exists(sent_path):
+                self._set(row['path'], self.SENT)
             else:
-                raise AssertionError('Unknown report type: {}'.format(report_type))
-        except Exception as e:
-            log.exception('Error occured on outbox processing %s %s', filename, repr(e))
-            if DEBUG:
-                import pdb; pdb.set_trace()  # noqa
-            continue
-        finally:
-            cabinet.quit()
+                log.error('Interrupted while sending %s, check cabinet before retry', row['path'])
+                self._set(row['path'], self.FAILED, 'interrupted while sending')
+
+    def _set(self, path, state, error=None, **fields):
+        fields = dict(fields, state=state, last_error=error, updated=time())
+        with self.db:
+            self.db.execute('UPDATE outbox_queue SET {} WHERE path = ?'.format(
+                ', '.join('{} = ?'.format(k) for k in fields)), tuple(fields.values()) + (path,))
+
+    def due(self, ignore_backoff=False):
+        return [row['path'] for row in self.db.execute(
+            'SELECT path FROM outbox_queue WHERE state = ? AND next_attempt <= ? ORDER BY path',
+            (self.PENDING, float('inf') if ignore_backoff else time()))]
+
+    def next_attempt(self):
+        row = self.db.execute('SELECT min(next_attempt) FROM outbox_queue WHERE state = ?',
+                              (self.PENDING,)).fetchone()
+        return row[0]
+
+    def retry_failed(self):
+        with self.db:
+            self.db.execute('UPDATE outbox_queue SET state = ?, attempts = 0, next_attempt = 0 '
+                            'WHERE state = ?', (self.PENDING, self.FAILED))
+
+    def start(self, path):
+        self._set(path, self.IN_FLIGHT, fingerprint=file_fingerprint(path))
+
+    def finish(self, path, error=None, retry=True):
+        if not error:
+            return self._set(path, self.SENT)
+        attempts = self.db.execute('SELECT attempts FROM outbox_queue WHERE path = ?',
+                                   (path,)).fetchone()[0] + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS or not retry:
+            return self._set(path, self.FAILED, error, attempts=attempts)
+        delay = min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_RETRY_DELAY)
+        self._set(path, self.PENDING, error, attempts=attempts, next_attempt=time() + delay)
+
+    def counts(self):
+        return dict(self.db.execute('SELECT state, count(*) FROM outbox_queue GROUP BY state'))
+
+
+def _send_outbox_inn(inn, key_path, items, sent_index, queue=None, in_doubt=None):
+    """
+    Sends all reports of inn in one session, returns {filename: error or None}.
+    Reports failed after send button was clicked are added to in_doubt, never retried blindly.
+    """
+    rv = OrderedDict((filename, 'not sent') for filename, _ in items)
+    cabinet = Cabinet()
+    try:
+        cabinet.login(key_path, inn=inn)
+        assert cabinet.inn == inn, 'Key inn in store and after login not matched!'
+    except Exception as e:
+        log.exception('Error occured on outbox login %s %s', inn, repr(e))
+        if config.debug:
+            import pdb; pdb.set_trace()  # noqa
+        cabinet.quit()
+        return OrderedDict((filename, repr(e)) for filename in rv)
 
-        log.info('Sent report inn=%s fio=%s filename=%s', cabinet.inn, cabinet.fio,
-                 os.path.basename(filename))
-        for filename in ([filename] + (subreports and list(subreports) or [])):
-            dest = os.path.join(sent_dir, os.path.basename(filename))
+    try:
+        for filename, header in items:
+            if queue:
+                queue.start(filename)
+            cabinet.send_clicked = False
+            try:
+                if header['C_DOC'] == 'F01':
+                    subreports = cabinet.send_f0103306_report(filename, key_path=key_path,
+                                                              header=header)
+                elif header['C_DOC'] == 'F30':
+                    subreports = cabinet.send_f3000511_report(filename, key_path=key_path)
+                else:
+                    raise AssertionError('Unknown report type: {}'.format(header['C_DOC']))
+            except Exception as e:
+                # next report starts from new form page, so failed one does not block others
+                log.exception('Error occured on outbox processing %s %s', filename, repr(e))
+                if config.debug:
+                    import pdb; pdb.set_trace()  # noqa
+                rv[filename] = repr(e)
+                if cabinet.send_clicked:
+                    log.error('Failed after send, check cabinet before retry %s', filename)
+                    rv[filename] = 'failed after send: {}'.format(repr(e))
+                    if in_doubt is not None:
+                        in_doubt.add(filename)
+                continue
+
+            log.info('Sent report inn=%s fio=%s filename=%s', cabinet.inn, cabinet.fio,
+                     os.path.basename(filename))
+            rv[filename] = None
+            sent_index.move(filename, header)
+            for subreport in (subreports or []):
+                sent_index.move(subreport)
+    finally:
+        cabinet.quit()
+    return rv
+
+
+def _int_or_none(value):
+    return int(value) if value and str(value).isdigit() else None
+
+
+class SentIndex(DbMixin):
+    """
+    Reports in sent dir by TIN, form, period and content fingerprint,
+    to find duplicates before sending without scanning the archive.
+    """
+    lock = threading.Lock()  # own moves of workers to sent dir
+
+    def __init__(self, sent_dir=SENT_DIR, db_filename=DB_FILENAME):
+        self.sent_dir = os.path.abspath(sent_dir)
+        self.db_filename = db_filename
+
+    def add(self, path, header, fingerprint=None, stat=None):
+        stat = stat or os.stat(path)
+        fingerprint = fingerprint or file_fingerprint(path)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO sent_index VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(path), _int_or_none(header['TIN']),
+                 (header['C_DOC'] or '').upper(), header['C_DOC_SUB'], header['C_DOC_STAN'],
+                 _int_or_none(header['PERIOD_YEAR']), _int_or_none(header['PERIOD_MONTH']),
+                 _int_or_none(header['PERIOD_TYPE']), fingerprint,
+                 stat.st_mtime, stat.st_size))
+
+    def sync(self):
+        """Indexes files put to sent dir not by send_outbox, skipped while dir is unchanged"""
+        # mtime before scan is the mark, so files added while scanning are seen next time
+        mtime = os.stat(self.sent_dir).st_mtime
+        if self._mark() == mtime:
+            return
+        indexed = dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            'SELECT path, mtime, size FROM sent_index WHERE path LIKE ?',
+            (os.path.join(self.sent_dir, '%'),)))
+        added = 0
+        with os.scandir(self.sent_dir) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith('.xml') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if indexed.pop(entry.path, None) != (stat.st_mtime, stat.st_size):
+                    self.add(entry.path, read_outbox_header(entry.path), stat=stat)
+                    added += 1
+        with self.db:
+            # left in indexed are deleted from sent dir, they are not duplicates anymore
+            self.db.executemany('DELETE FROM sent_index WHERE path = ?',
+                                ((path,) for path in indexed))
+        self._set_mark(mtime)
+        log.info('Sent index synced, added %s, removed %s', added, len(indexed))
+
+    def _mark(self):
+        row = self.db.execute('SELECT mtime FROM dir_mtimes WHERE path = ?',
+                              (self.sent_dir,)).fetchone()
+        return row and row[0]
+
+    def _set_mark(self, mtime):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO dir_mtimes VALUES (?, ?)',
+                            (self.sent_dir, mtime))
+
+    def move(self, path, header=None):
+        """
+        Moves sent report to sent dir and indexes it. If dir was synced before the move,
+        mark follows it, so own moves don't make next sync scan the archive.
+        """
+        dest = os.path.join(self.sent_dir, os.path.basename(path))
+        with SentIndex.lock:
+            synced = self._mark() == os.stat(self.sent_dir).st_mtime
             maybe_remove(dest)
-            os.rename(filename, dest)
-            # TODO: add to xls log, or rename budget_status to just status?
+            os.rename(path, dest)
+            self.add(dest, header or read_outbox_header(dest))
+            if synced:
+                self._set_mark(os.stat(self.sent_dir).st_mtime)
+        return dest
+
+    def find(self, path, header):
+        """Path of sent report with same content, or same TIN, form, state and period"""
+        row = self.db.execute('SELECT path FROM sent_index WHERE fingerprint = ? LIMIT 1',
+                              (file_fingerprint(path),)).fetchone()
+        if row:
+            return row[0]
+        row = self.db.execute(
+            'SELECT path FROM sent_index WHERE tin = ? AND c_doc = ? AND c_doc_sub IS ? '
+            'AND c_doc_stan IS ? AND period_year IS ? AND period_month IS ? '
+            'AND period_type IS ? LIMIT 1',
+            (_int_or_none(header['TIN']), (header['C_DOC'] or '').upper(), header['C_DOC_SUB'],
+             header['C_DOC_STAN'], _int_or_none(header['PERIOD_YEAR']),
+             _int_or_none(header['PERIOD_MONTH']), _int_or_none(header['PERIOD_TYPE']))
+        ).fetchone()
+        return row and row[0]
+
+
+def _send_queued(queue, files, sent_dir):
+    keys_map = KeysMap()
+    plan = plan_outbox(files, keys_map)
+    log.info('Outbox planned %s reports for %s inns',
+             sum(len(items) for items in plan.values()), len(plan))
+
+    results = OrderedDict((filename, 'inn not found in keys map or unknown report')
+                          for filename in files)
+    duplicates, in_doubt = set(), set()
+    sent_index = SentIndex(sent_dir)
+    sent_index.sync()
+    if not config.resend:
+        for inn, items in plan.items():
+            for filename, header in tuple(items):
+                duplicate = sent_index.find(filename, header)
+                if duplicate:
+                    log.error('Already sent as %s (skipping, use --resend to send anyway) %s',
+                              os.path.basename(duplicate), filename)
+                    results[filename] = 'already sent as {}'.format(duplicate)
+                    duplicates.add(filename)
+                    items.remove((filename, header))
+
+    def send(inn):
+        items = plan[inn]
+        with metrics.span('inn', inn) as span:
+            inn_results = _send_outbox_inn(inn, keys_map.get_path(inn), items, sent_index,
+                                           queue, in_doubt)
+            span.error = next((error for error in inn_results.values() if error), None)
+        return inn_results
+
+    for inn_results in scheduler.map(send, [inn for inn, items in plan.items() if items],
+                                     failed=lambda inn_results: any(inn_results.values())):
+        results.update(inn_results)
+    no_retry = duplicates | in_doubt
+    for filename, error in results.items():
+        queue.finish(filename, error, retry=filename not in no_retry)
+    return results
 
 
-if __name__ == '__main__':
-    funcs = ['scan_keys', 'get_info', 'get_report_status', 'send_outbox']
+def send_outbox(outbox_dir=OUTBOX_DIR, sent_dir=SENT_DIR):
+    queue = OutboxQueue()
+    queue.recover(sent_dir)
+    if config.retry_failed:
+        queue.retry_failed()
+    files = tuple(glob.iglob(os.path.join(outbox_dir, '*.xml')))
+    log.info('Outbox (%s) in %s', len(files), outbox_dir)
+    queue.enqueue(files)
+
+    results = _send_queued(queue, queue.due(ignore_backoff=True), sent_dir)
+
+    failed = [filename for filename, error in results.items() if error]
+    log.info('Outbox sent %s, failed %s, queue %s',
+             len(results) - len(failed), len(failed), queue.counts())
+    for filename in failed:
+        log.warning('Not sent %s: %s', os.path.basename(filename), results[filename])
+    return results
+
+
+class OutboxWatcher:
+    """Waits for outbox changes with inotify where available, polls directory mtime otherwise"""
+
+    def __init__(self, outbox_dir):
+        self.outbox_dir = outbox_dir
+        self.mtime = None
+        self.inotify = None
+        if inotify_simple:
+            flags = inotify_simple.flags
+            self.inotify = inotify_simple.INotify()
+            self.inotify.add_watch(outbox_dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+
+    def wait(self, timeout):
+        if self.inotify:
+            return bool(self.inotify.read(timeout=int(timeout * 1000)))
+        deadline = time() + timeout
+        while True:
+            mtime = os.stat(self.outbox_dir).st_mtime
+            if mtime != self.mtime:
+                self.mtime = mtime
+                return True
+            if time() >= deadline:
+                return False
+            sleep(max(0, min(OUTBOX_POLL_INTERVAL, deadline - time())))
+
+
+def watch_outbox(outbox_dir=OUTBOX_DIR, sent_dir=SENT_DIR, idle_timeout=600):
+    queue = OutboxQueue()
+    queue.recover(sent_dir)
+    if config.retry_failed:
+        queue.retry_failed()
+    watcher = OutboxWatcher(outbox_dir)
+    log.info('Watching outbox %s (%s)', outbox_dir, 'inotify' if watcher.inotify else 'polling')
+
+    changed = True
+    while True:
+        if changed:
+            files = glob.glob(os.path.join(outbox_dir, '*.xml'))
+            # not settled files are picked on next round, even without new changes
+            changed = bool(queue.enqueue(files))
+        due = queue.due()
+        if due:
+            _send_queued(queue, due, sent_dir)
+            metrics.flush()
+            log.info('Outbox queue %s', queue.counts())
+            continue
+
+        timeout = idle_timeout
+        next_attempt = queue.next_attempt()
+        if next_attempt:
+            timeout = min(timeout, max(0, next_attempt - time()))
+        if changed:
+            timeout = min(timeout, OUTBOX_SETTLE_TIME)
+        changed = watcher.wait(timeout) or changed
+
+
+COMMANDS = ('scan_keys', 'get_info', 'get_report_status', 'get_report_history', 'send_outbox',
+            'watch_outbox', 'warm_profile')
+FLAGS = ('debug', 'retry-failed', 'resend', 'resume', 'fresh-login', 'saldo-report')
+OPTIONS = ('workers', 'rate', 'only', 'cabinet-url', 'keys-dir', 'info-file', 'report-status-file',
+           'outbox-dir', 'sent-dir', 'idle-timeout', 'payer-ttl', 'budget-ttl', 'reports-ttl',
+           'report-history-file', 'history-from', 'export', 'browser-sessions',
+           'browser-rss', 'session-key')
+EXIT_OK = 0
+EXIT_FAILED = 1  # some inns, keys or reports failed
+EXIT_USAGE = 2
+EXIT_ERROR = 3  # command stopped by error, next commands are not run
+
+USAGE = '''usage: sfs_cabinet.py [command ...] [--flag ...] [--option=value ...]
+
+Runs commands one after another in one process (menu without commands), prints json summary
+{{"exit_code": ..., "commands": {{command: {{"failed": n}} or {{"error": ...}}}}}}.
+Exit code 0 - all done, 1 - some inns, keys or reports failed, 2 - usage error,
+3 - command stopped by error.
+
+commands: {}
+flags: {}
+options: {}
+'''.format(' '.join(COMMANDS), ' '.join('--' + flag for flag in FLAGS),
+           ' '.join('--{}='.format(option) for option in OPTIONS))
+
+
+def get_usage_error(args):
+    for arg in args:
+        if arg.startswith('--'):
+            name, eq, _ = arg[2:].partition('=')
+            if (name not in FLAGS or eq) and (name not in OPTIONS or not eq):
+                return 'unknown flag or option without value: {}'.format(arg)
+        elif arg not in COMMANDS:
+            return 'unknown command: {}'.format(arg)
+    commands = [arg for arg in args if not arg.startswith('--')]
+    if 'watch_outbox' in commands[:-1]:
+        return 'watch_outbox does not return, it can be the last command only'
+    return None
+
+
+def run_command(command):
+    """Runs command with paths of options, returns number of failed inns, keys or reports"""
+    if command == 'scan_keys':
+        return len(scan_keys(config.keys_dir))
+    if command == 'get_info':
+        return get_info(config.info_file).get(ReportJob.FAILED, 0)
+    if command == 'get_report_status':
+        return get_report_status(config.report_status_file).get(ReportJob.FAILED, 0)
+    if command == 'get_report_history':
+        return len(get_report_history(config.report_history_file))
+    if command == 'send_outbox':
+        results = send_outbox(config.outbox_dir, config.sent_dir)
+        return sum(1 for error in results.values() if error)
+    if command == 'watch_outbox':
+        watch_outbox(config.outbox_dir, config.sent_dir, config.idle_timeout)
+        return 0
+    if command == 'warm_profile':
+        warm_profile()
+        return 0
+    raise ValueError('Unknown command: {}'.format(command))
+
+
+def main(args):
+    """
+    Runs commands of args in one process, so keys map, browsers and metrics are shared
+    by them. Returns exit code.
+    """
+    global driver_pool
+    if '--help' in args or '-h' in args:
+        print(USAGE)
+        return EXIT_OK
+    error = get_usage_error(args)
+    if not error:
+        try:
+            configure(args)
+        except ValueError as e:
+            error = 'invalid option value: {}'.format(e)
+    if error:
+        sys.stderr.write('{}\n\n{}'.format(error, USAGE))
+        return EXIT_USAGE
+
+    setup_logging()
+    supervisor.kill_orphans()
+    commands = [arg for arg in args if not arg.startswith('--')]
+    interactive = not commands
+    driver_pool = DriverPool(scheduler.max_workers)
+    code = EXIT_OK
+    results = OrderedDict()
     try:
-        func = choice.Menu(funcs).ask()
-        globals()[func]()
-    except Exception as e:
-        log.exception(repr(e))
-    input('DONE. press any key to close')
+        if interactive:
+            commands = [choice.Menu(list(COMMANDS)).ask()]
+        for command in commands:
+            try:
+                failed = run_command(command)
+            except Exception as e:
+                log.exception('Error occured on %s %s', command, repr(e))
+                if config.debug:
+                    import pdb; pdb.set_trace()  # noqa
+                results[command] = {'error': repr(e)}
+                code = EXIT_ERROR
+                break
+            results[command] = {'failed': failed}
+            if failed:
+                code = EXIT_FAILED
+    finally:
+        driver_pool.close()
+        driver_pool = None
+        supervisor.report()
+        metrics.close()
+    print(json.dumps({'exit_code': code, 'commands': results}, ensure_ascii=False))
+    if interactive:
+        input('DONE. press any key to close')
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))